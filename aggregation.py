@@ -0,0 +1,449 @@
+# -*- coding: utf-8 -*-
+# @File    : aggregation.py
+
+from collections import OrderedDict
+import time
+import numpy as np
+import torch
+
+from sos import StochasticOutlierSelection
+
+
+class ClientUpdateStore:
+    """
+    Client updates of one round as rows of a single (capacity, num_params) matrix.
+
+    Every state_dict written to the store is flattened into its row, so aggregation rules
+    reduce or gather over one tensor instead of walking a list of dicts key by key.
+    With a filename the matrix is a numpy memmap on disk, which keeps 10k+ clients out
+    of RAM. store[i] returns the state_dict of client i as views into the matrix.
+    """
+
+    def __init__(self, template, capacity, dtype=None, filename=None, device=torch.device('cpu')):
+        """
+        Parameters
+        ----------
+        template : dict
+            state_dict giving the keys, shapes and dtypes of the stored updates
+        capacity : int
+            maximal number of clients
+        dtype : torch.dtype, optional
+            dtype of the matrix, the first floating point dtype of template by default
+        filename : str, optional
+            backing file of a memory-mapped matrix
+        device : torch.device, optional
+            device of the in-memory matrix, ignored with a filename
+        """
+        self.keys = list(template.keys())
+        self.shapes = {k: template[k].shape for k in self.keys}
+        self.dtypes = {k: template[k].dtype for k in self.keys}
+        if dtype is None:
+            dtype = next((template[k].dtype for k in self.keys if template[k].is_floating_point()), torch.float32)
+        offsets = np.cumsum([0] + [template[k].numel() for k in self.keys])
+        self.slices = {k: slice(int(offsets[i]), int(offsets[i + 1])) for i, k in enumerate(self.keys)}
+        self.num_params = int(offsets[-1])
+        self.capacity = capacity
+        self.filename = filename
+        if filename is not None:
+            np_dtype = torch.empty((), dtype=dtype).numpy().dtype
+            self._memmap = np.memmap(filename, dtype=np_dtype, mode='w+', shape=(capacity, self.num_params))
+            self.data = torch.from_numpy(self._memmap)
+        else:
+            self._memmap = None
+            self.data = torch.empty((capacity, self.num_params), dtype=dtype, device=device)
+        self.count = 0
+
+    def flatten(self, state_dict):
+        """
+        Returns
+        -------
+         : torch.Tensor
+            (num_params,) concatenation of the entries of state_dict in the order of the store
+        """
+        return torch.cat([state_dict[k].reshape(-1).to(self.data.device, self.data.dtype) for k in self.keys])
+
+    def to_state_dict(self, flat):
+        """
+        Parameters
+        ----------
+        flat : torch.Tensor
+            (num_params,) vector, e.g. a reduction over the rows of the store
+
+        Returns
+        -------
+         : OrderedDict
+            state_dict with the shapes and dtypes of the template, owning its memory
+        """
+        return OrderedDict((k, flat[self.slices[k]].reshape(self.shapes[k]).to(self.dtypes[k]).clone())
+                           for k in self.keys)
+
+    def write(self, i, state_dict):
+        row = self.data[i]
+        for k in self.keys:
+            row[self.slices[k]].copy_(state_dict[k].reshape(-1))
+        self.count = max(self.count, i + 1)
+
+    def append(self, state_dict):
+        if self.count >= self.capacity:
+            raise IndexError(f'ClientUpdateStore is full ({self.capacity} clients)')
+        self.write(self.count, state_dict)
+
+    def rows(self):
+        """
+        Returns
+        -------
+         : torch.Tensor
+            (len(self), num_params) view of the written updates
+        """
+        return self.data[:self.count]
+
+    def layer(self, key):
+        """
+        Returns
+        -------
+         : torch.Tensor
+            (len(self), numel) view of the entry key of every written update
+        """
+        return self.data[:self.count, self.slices[key]]
+
+    def mean(self, mask=None):
+        """
+        Parameters
+        ----------
+        mask : array-like of bool, optional
+            clients to average, all of them by default
+
+        Returns
+        -------
+         : OrderedDict
+            state_dict of the average update
+        """
+        rows = self.rows()
+        if mask is not None:
+            rows = rows[torch.as_tensor(np.asarray(mask, dtype=bool), device=rows.device)]
+        return self.to_state_dict(rows.mean(dim=0))
+
+    def flush(self):
+        if self._memmap is not None:
+            self._memmap.flush()
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self.count
+        if not 0 <= i < self.count:
+            raise IndexError(i)
+        return OrderedDict((k, self.data[i, self.slices[k]].view(self.shapes[k]).to(self.dtypes[k]))
+                           for k in self.keys)
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        for i in range(self.count):
+            yield self[i]
+
+
+class StreamingFedAvg:
+    """
+    Running weighted average of client updates.
+
+    Updates are folded into a float64 running sum as soon as they are added, so the memory
+    is one model whatever the number of clients and aggregation overlaps with the training
+    of the clients that have not finished yet.
+    """
+
+    def __init__(self):
+        self._sum = None
+        self._dtypes = None
+        self.total_weight = 0.
+        self.count = 0
+
+    def add(self, update, weight=1.0):
+        """
+        Parameters
+        ----------
+        update : dict
+            state_dict of one client
+        weight : float, optional
+            e.g. the number of training samples of the client, 1 for the plain FedAvg mean
+        """
+        if self._sum is None:
+            self._dtypes = OrderedDict((k, v.dtype) for k, v in update.items())
+            self._sum = OrderedDict((k, v.detach().to(torch.float64) * weight) for k, v in update.items())
+        else:
+            for k, v in update.items():
+                self._sum[k].add_(v.detach().to(torch.float64), alpha=weight)
+        self.total_weight += weight
+        self.count += 1
+
+    def result(self):
+        """
+        Returns
+        -------
+         : OrderedDict
+            weighted average state_dict, in the dtypes of the added updates
+        """
+        if self._sum is None:
+            raise ValueError('StreamingFedAvg.result called before any update was added')
+        return OrderedDict((k, (s / self.total_weight).to(self._dtypes[k])) for k, s in self._sum.items())
+
+
+def frequent_indices(omega_locals, min_count=90):
+    """
+    Parameter indices selected as important by more than min_count clients.
+
+    Parameters
+    ----------
+    omega_locals : list of dict
+        omega_index of every client, parameter name -> flat indices
+    min_count : int, optional
+
+    Returns
+    -------
+    selected_index : OrderedDict
+        parameter name -> sorted LongTensor of flat indices
+    """
+    selected_index = OrderedDict()
+    for n in omega_locals[0].keys():
+        flat = np.concatenate([np.asarray(omega[n], dtype=np.int64).reshape(-1) for omega in omega_locals])
+        counts = np.bincount(flat) if len(flat) > 0 else np.zeros(0, dtype=np.int64)
+        selected_index[n] = torch.as_tensor(np.flatnonzero(counts > min_count))
+    return selected_index
+
+
+def update_features(w_locals, w_local_pre, selected_index):
+    """
+    Change of the selected parameters of every client since the previous global model.
+
+    Parameters
+    ----------
+    w_locals : ClientUpdateStore or list of dict
+    w_local_pre : dict
+        global state_dict the clients started from
+    selected_index : dict
+        parameter name -> LongTensor of flat indices, see frequent_indices
+
+    Returns
+    -------
+     : torch.Tensor
+        (clients, features) matrix, one index_select per layer for all clients at once
+    """
+    columns = list()
+    for n, indices in selected_index.items():
+        if len(indices) == 0:
+            continue
+        if isinstance(w_locals, ClientUpdateStore):
+            layer = w_locals.layer(n)
+        else:
+            layer = torch.stack([w[n].reshape(-1) for w in w_locals])
+        indices = indices.to(layer.device)
+        pre = w_local_pre[n].reshape(-1).to(layer.device, layer.dtype)
+        columns.append(layer.index_select(1, indices) - pre.index_select(0, indices))
+    if len(columns) == 0:
+        return torch.zeros((len(w_locals), 0))
+    return torch.cat(columns, dim=1)
+
+
+AGGREGATORS = OrderedDict()
+
+
+def register_aggregator(name):
+    """
+    Registers fn(store, w_pre, **options) -> (flat, labels) as the aggregation backend name.
+
+    flat is the (num_params,) aggregated model, labels the (clients,) int array marking the
+    clients the backend rejected or altered with 1. Backends ignore the options of the others.
+    """
+    def decorator(fn):
+        AGGREGATORS[name] = fn
+        return fn
+    return decorator
+
+
+def aggregate(name, w_locals, w_pre, **options):
+    """
+    Runs the aggregation backend name of AGGREGATORS and reports its time.
+
+    Parameters
+    ----------
+    name : str
+        key of AGGREGATORS
+    w_locals : ClientUpdateStore or list of dict
+        client updates
+    w_pre : dict
+        global state_dict the clients started from
+    options :
+        keyword arguments of the backends, e.g. omega_locals, num_byzantine, trim_ratio
+
+    Returns
+    -------
+    w_glob : OrderedDict
+        aggregated state_dict
+    labels : np.ndarray
+        1 for the clients rejected or altered by the backend
+    seconds : float
+        time of the backend alone
+    """
+    if name not in AGGREGATORS:
+        raise ValueError(f'unknown aggregation backend {name}, choose from {list(AGGREGATORS)}')
+    store = w_locals
+    if not isinstance(store, ClientUpdateStore):
+        store = ClientUpdateStore(w_locals[0], len(w_locals))
+        for w in w_locals:
+            store.append(w)
+    if store.data.is_cuda:
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    flat, labels = AGGREGATORS[name](store, w_pre, **options)
+    if store.data.is_cuda:
+        torch.cuda.synchronize()
+    seconds = time.perf_counter() - start
+    print('aggregation {} | clients {} | params {} | time {:.4f}s'.format(name, len(store), store.num_params, seconds))
+    return store.to_state_dict(flat), np.asarray(labels, dtype=int), seconds
+
+
+def _column_blocks(store, max_elements=1 << 24):
+    # parameter slices of at most max_elements entries of the (clients, params) matrix
+    width = max(1, max_elements // max(1, len(store)))
+    for start in range(0, store.num_params, width):
+        yield slice(start, min(start + width, store.num_params))
+
+
+def _weighted_sum(store, weights):
+    # weights @ rows, accumulated in float64 block by block
+    weights = torch.as_tensor(weights, dtype=torch.float64, device=store.data.device)
+    flat = torch.empty(store.num_params, dtype=torch.float64, device=store.data.device)
+    rows = store.rows()
+    for s in _column_blocks(store):
+        flat[s] = weights @ rows[:, s].to(torch.float64)
+    return flat
+
+
+@register_aggregator('fedavg')
+def fedavg_backend(store, w_pre, **options):
+    n = len(store)
+    return _weighted_sum(store, np.full(n, 1. / n)), np.zeros(n, dtype=int)
+
+
+@register_aggregator('median')
+def median_backend(store, w_pre, **options):
+    """Coordinate-wise median, the mean of the two middle values for an even number of clients."""
+    n = len(store)
+    rows = store.rows()
+    flat = torch.empty(store.num_params, dtype=torch.float64, device=store.data.device)
+    for s in _column_blocks(store):
+        # selection is exact in the dtype of the store and faster along contiguous rows
+        block = rows[:, s].T.contiguous()
+        lower = torch.kthvalue(block, (n + 1) // 2, dim=1).values.to(torch.float64)
+        upper = torch.kthvalue(block, n // 2 + 1, dim=1).values.to(torch.float64)
+        flat[s] = (lower + upper) / 2
+    return flat, np.zeros(n, dtype=int)
+
+
+@register_aggregator('trimmed_mean')
+def trimmed_mean_backend(store, w_pre, trim_ratio=0.1, **options):
+    """Coordinate-wise mean without the int(trim_ratio * clients) largest and smallest values."""
+    n = len(store)
+    k = int(trim_ratio * n)
+    if 2 * k >= n:
+        raise ValueError(f'trim_ratio {trim_ratio} trims all {n} clients')
+    rows = store.rows()
+    flat = torch.empty(store.num_params, dtype=torch.float64, device=store.data.device)
+    for s in _column_blocks(store):
+        block = rows[:, s].T.contiguous()
+        total = block.sum(dim=1, dtype=torch.float64)
+        if k > 0:
+            # partial selection of the extremes instead of a full sort
+            total -= torch.topk(block, k, dim=1, largest=True, sorted=False).values.sum(dim=1, dtype=torch.float64)
+            total -= torch.topk(block, k, dim=1, largest=False, sorted=False).values.sum(dim=1, dtype=torch.float64)
+        flat[s] = total / (n - 2 * k)
+    return flat, np.zeros(n, dtype=int)
+
+
+def krum_scores(store, w_pre, num_byzantine):
+    """
+    Krum score of every client, the sum of the squared distances to its n - f - 2 nearest updates.
+
+    The (clients, clients) Gram matrix of the updates w_i - w_pre is accumulated block by block
+    over the parameters, so the distances never need the whole matrix in memory at once.
+    """
+    n = len(store)
+    rows = store.rows()
+    pre = store.flatten(w_pre).to(torch.float64)
+    gram = torch.zeros((n, n), dtype=torch.float64, device=store.data.device)
+    for s in _column_blocks(store):
+        block = rows[:, s].to(torch.float64) - pre[s]
+        gram += block @ block.T
+    sq_norm = gram.diagonal()
+    distances = (sq_norm[:, None] + sq_norm[None, :] - 2 * gram).clamp_(min=0)
+    distances.fill_diagonal_(np.inf)
+    k = min(max(1, n - num_byzantine - 2), n - 1)
+    return torch.topk(distances, k, dim=1, largest=False, sorted=False).values.sum(dim=1)
+
+
+@register_aggregator('krum')
+def krum_backend(store, w_pre, num_byzantine=0, **options):
+    """Update of the client with the lowest Krum score."""
+    return multi_krum_backend(store, w_pre, num_byzantine=num_byzantine, num_selected=1)
+
+
+@register_aggregator('multi_krum')
+def multi_krum_backend(store, w_pre, num_byzantine=0, num_selected=None, **options):
+    """Mean of the num_selected clients with the lowest Krum scores, n - num_byzantine by default."""
+    n = len(store)
+    if num_selected is None:
+        num_selected = n - num_byzantine
+    num_selected = min(max(1, num_selected), n)
+    scores = krum_scores(store, w_pre, num_byzantine)
+    selected = torch.topk(scores, num_selected, largest=False, sorted=False).indices.cpu().numpy()
+    labels = np.ones(n, dtype=int)
+    labels[selected] = 0
+    weights = np.where(labels == 0, 1. / num_selected, 0.)
+    return _weighted_sum(store, weights), labels
+
+
+@register_aggregator('norm_clip')
+def norm_clip_backend(store, w_pre, clip_norm=None, **options):
+    """
+    Mean of the updates w_i - w_pre clipped to the L2 norm clip_norm, the median norm by default.
+    The clipped clients are labelled 1.
+    """
+    n = len(store)
+    rows = store.rows()
+    pre = store.flatten(w_pre).to(torch.float64)
+    sq_norm = torch.zeros(n, dtype=torch.float64, device=store.data.device)
+    for s in _column_blocks(store):
+        sq_norm += ((rows[:, s].to(torch.float64) - pre[s]) ** 2).sum(dim=1)
+    norms = sq_norm.sqrt()
+    if clip_norm is None:
+        clip_norm = torch.quantile(norms, 0.5).item()
+    scale = (clip_norm / norms.clamp(min=1e-12)).clamp(max=1.)
+    weights = scale / n
+    # w_pre + sum_i weights_i (w_i - w_pre)
+    flat = _weighted_sum(store, weights) + (1 - weights.sum()) * pre
+    return flat, (norms > clip_norm).long().cpu().numpy()
+
+
+@register_aggregator('our')
+def sos_filter_backend(store, w_pre, omega_locals=None, min_count=90, contamination=0.4, perplexity=90,
+                       n_neighbors=None, **options):
+    """
+    SOS filter of SecFedNIDS: SOS on the min-max scaled change of the parameters that are important
+    for more than min_count clients, then the sum of the clean clients divided by their number, the
+    first client always being kept as in the original defence_det.
+    """
+    n = len(store)
+    X = update_features(store, w_pre, frequent_indices(omega_locals, min_count=min_count)).to(torch.float64)
+    print('X', tuple(X.shape))
+    # MinMaxScaler, constant features are mapped to 0
+    low = X.min(dim=0).values
+    span = X.max(dim=0).values - low
+    span[span == 0] = 1.
+    X = (X - low) / span
+    clf = StochasticOutlierSelection(contamination=contamination, perplexity=perplexity, n_neighbors=n_neighbors)
+    clf.fit(X.cpu().numpy())
+    labels = clf.labels_
+    keep = labels == 0
+    keep[0] = True
+    weights = np.where(keep, 1. / (n - labels.sum()), 0.)
+    return _weighted_sum(store, weights), labels
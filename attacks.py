@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+# @File    : attacks.py
+
+import numpy as np
+import torch
+
+
+def sign_flip(update, reference, scale=1.):
+    """reference - scale * (update - reference): the update pushes the model the other way"""
+    return reference - scale * (update - reference)
+
+
+def scale_update(update, reference, scale=1.):
+    """reference + scale * (update - reference): model replacement / boosted update"""
+    return reference + scale * (update - reference)
+
+
+MODEL_ATTACKS = {
+    'sign_flip': sign_flip,
+    'scale': scale_update,
+}
+
+
+def _per_client(value, clients):
+    # a scalar setting or the entries of clients of a per-client array
+    return np.full(len(clients), value) if np.ndim(value) == 0 else np.asarray(value)[clients]
+
+
+class PoisonedRound:
+    """
+    Clients of one round after the attacks of a PoisoningScenario.
+
+    Attributes
+    ----------
+    poisoned : np.ndarray
+        (num_clients,) bool, the attacking clients
+    index : dict
+        client -> rows of its shard
+    label_positions, label_values : dict
+        client -> positions in index of the relabelled rows and their new labels
+    truth : dict
+        client -> (len(index),) bool ground truth of the poisoned samples: the kept source
+        rows, relabelled or not, the other rows of the shard being clean
+    """
+
+    def __init__(self, poisoned, index, label_positions, label_values, truth):
+        self.poisoned = poisoned
+        self.index = index
+        self.label_positions = label_positions
+        self.label_values = label_values
+        self.truth = truth
+
+
+class PoisoningScenario:
+    """
+    Which clients attack in which round, and how.
+
+    In every round of rounds, the first max_clients eligible clients of clients attack. The
+    data attack is a label flip: of the rows of the client in source_classes, only the first
+    keep_ratio are kept and the first flip_ratio are relabelled target_class, the kept rows
+    following the clean ones. With the defaults (every attack class relabelled normal) it is
+    the label-flipping attack of SecFedNIDS; a single source class makes it a targeted flip.
+    A client is eligible when it has rows to flip, or always without a data attack. Every
+    kept source row of an attacker counts as poisoned in the ground truth, also those left
+    with their label when keep_ratio exceeds flip_ratio.
+    model_attack ('sign_flip', 'scale') then alters the updates of the attacking clients.
+
+    flip_ratio, keep_ratio and scale are scalars or (num_clients,) arrays of per-client values.
+    plan() works on the concatenated shards with masks and cumulative counts, in O(dataset).
+
+    Parameters
+    ----------
+    rounds : iterable of int
+        rounds with attacks
+    max_clients : int
+        attacking clients per round
+    clients : array-like, optional
+        candidate attackers, every client by default
+    data_attack : str, optional
+        'label_flip' or None
+    source_classes : array-like, optional
+        classes of the flipped rows, every class but target_class by default
+    target_class : int
+    binary : bool
+        the model is trained on normal (0) / attack labels: source classes must differ from
+        target_class in that binary label, by default they are the classes that do
+    flip_ratio : float or np.ndarray
+        fraction of the source rows relabelled
+    keep_ratio : float or np.ndarray
+        fraction of the source rows kept in the shard (--prate)
+    model_attack : str, optional
+        key of MODEL_ATTACKS
+    scale : float or np.ndarray
+        factor of the model attack
+    """
+
+    def __init__(self, rounds, max_clients=40, clients=None, data_attack='label_flip', source_classes=None,
+                 target_class=0, binary=False, flip_ratio=0.8, keep_ratio=1., model_attack=None, scale=1.):
+        if data_attack not in (None, 'label_flip'):
+            raise ValueError(f'unknown data attack {data_attack}')
+        if binary and source_classes is not None and any((c != 0) == (target_class != 0) for c in source_classes):
+            raise ValueError(f'source classes {list(source_classes)} with the binary label of target class '
+                             f'{target_class} would not change any training label')
+        if model_attack is not None and model_attack not in MODEL_ATTACKS:
+            raise ValueError(f'unknown model attack {model_attack}, one of {list(MODEL_ATTACKS)}')
+        self.rounds = set(rounds)
+        self.max_clients = max_clients
+        self.clients = clients
+        self.data_attack = data_attack
+        self.source_classes = source_classes
+        self.target_class = target_class
+        self.binary = binary
+        self.flip_ratio = flip_ratio
+        self.keep_ratio = keep_ratio
+        self.model_attack = model_attack
+        self.scale = scale
+
+    def plan(self, round, labels, dict_clients):
+        """
+        Parameters
+        ----------
+        round : int
+        labels : array-like
+            (n,) class of every row of the training set
+        dict_clients : dict
+            client -> np.ndarray of its rows, clients 0 .. num_clients - 1
+
+        Returns
+        -------
+         : PoisonedRound
+        """
+        num_clients = len(dict_clients)
+        labels = np.asarray(labels)
+        parts = [np.asarray(dict_clients[c], dtype=np.int64) for c in range(num_clients)]
+        lengths = np.array([len(p) for p in parts], dtype=np.int64)
+        rows = np.concatenate(parts)
+        owner = np.repeat(np.arange(num_clients), lengths)
+
+        candidate = np.zeros(num_clients, dtype=bool)
+        if round in self.rounds:
+            candidate[np.arange(num_clients) if self.clients is None else np.asarray(self.clients)] = True
+        if self.data_attack is not None:
+            sources = self.source_classes
+            if sources is None:
+                sources = np.setdiff1d(np.unique(labels[rows]), [self.target_class])
+                if self.binary:
+                    sources = sources[(sources != 0) != (self.target_class != 0)]
+            source = np.isin(labels[rows], sources)
+            num_source = np.bincount(owner, weights=source, minlength=num_clients).astype(np.int64)
+            num_flip = (num_source * _per_client(self.flip_ratio, np.arange(num_clients))).astype(np.int64)
+            num_kept = (num_source * _per_client(self.keep_ratio, np.arange(num_clients))).astype(np.int64)
+            candidate &= num_flip > 0
+        poisoned = candidate & (np.cumsum(candidate) <= self.max_clients)
+
+        index = dict(enumerate(parts))
+        label_positions = {c: np.zeros(0, dtype=np.int64) for c in range(num_clients)}
+        label_values = {c: np.zeros(0, dtype=labels.dtype) for c in range(num_clients)}
+        truth = {c: np.zeros(lengths[c], dtype=bool) for c in range(num_clients)}
+        if self.data_attack is not None and poisoned.any():
+            # rank of every source row among the source rows of its client
+            before = np.concatenate(([0], np.cumsum(source)))
+            rank = before[1:] - source - before[np.cumsum(lengths) - lengths][owner]
+            attacked = poisoned[owner]
+            keep = attacked & (~source | (rank < num_kept[owner]))
+            flip = source & (rank < np.minimum(num_flip, num_kept)[owner])
+            # kept rows grouped by client, clean rows first, each in shard order
+            kept = np.flatnonzero(keep)
+            kept = kept[np.lexsort((source[kept], owner[kept]))]
+            counts = np.bincount(owner[kept], minlength=num_clients)
+            splits = np.cumsum(counts)[:-1]
+            for c, kept_rows, kept_flip, kept_source in zip(np.arange(num_clients), np.split(rows[kept], splits),
+                                                            np.split(flip[kept], splits), np.split(source[kept], splits)):
+                if poisoned[c]:
+                    index[c] = kept_rows
+                    truth[c] = kept_source
+                    label_positions[c] = np.flatnonzero(kept_flip)
+                    label_values[c] = np.full(len(label_positions[c]), self.target_class, dtype=labels.dtype)
+        return PoisonedRound(poisoned, index, label_positions, label_values, truth)
+
+    def attack_update(self, client, state_dict, reference):
+        """
+        The model attack applied to the state_dict of one attacking client, its floating point
+        entries moved relative to reference (the global model the client started from).
+        """
+        if self.model_attack is None:
+            return state_dict
+        attack = MODEL_ATTACKS[self.model_attack]
+        scale = float(_per_client(self.scale, [client])[0])
+        return state_dict.__class__((k, attack(v, reference[k].to(v.device, v.dtype), scale)
+                                     if v.is_floating_point() else v) for k, v in state_dict.items())
+
+    def attack_store(self, store, clients, reference):
+        """
+        The model attack applied in place to the rows clients of a ClientUpdateStore, one
+        operation per entry for all of them.
+        """
+        clients = np.asarray(clients, dtype=np.int64)
+        if self.model_attack is None or len(clients) == 0:
+            return store
+        attack = MODEL_ATTACKS[self.model_attack]
+        rows = torch.as_tensor(clients, device=store.data.device)
+        scale = torch.as_tensor(_per_client(self.scale, clients), dtype=store.data.dtype,
+                                device=store.data.device)[:, None]
+        for k in store.keys:
+            if not store.dtypes[k].is_floating_point:
+                continue
+            block = store.data[rows, store.slices[k]]
+            store.data[rows, store.slices[k]] = attack(block, reference[k].reshape(1, -1).to(block.device, block.dtype),
+                                                       scale)
+        return store
@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+# @File    : dataset_cache.py
+
+import argparse
+import json
+import os
+from collections import Counter
+import numpy as np
+import pandas as pd
+from sklearn.utils import shuffle
+from imblearn.over_sampling import RandomOverSampler
+from imblearn.under_sampling import RandomUnderSampler
+
+MANIFEST = 'manifest.json'
+ARRAYS = ('x_train', 'y_train', 'x_test', 'y_test')
+WEIGHTED_ARRAYS = ARRAYS + ('w_train', 'w_test')
+
+# sampling of readdataset: class sizes of the under/over-sampling, then [start, stop) row ranges
+# of the label-sorted frame kept for training and for testing
+SAMPLING = {
+    'random_state': 0,
+    'under': {0: 400000, 1: 100000, 2: 44525, 3: 24246, 4: 16353, 5: 0, 6: 0, 7: 0, 8: 0, 9: 0},
+    'over': {0: 400000, 1: 100000, 2: 100000, 3: 100000, 4: 100000},
+    'train': [[0, 280000], [400000, 470000], [500000, 570000], [600000, 670000], [700000, 770000]],
+    'test': [[280000, 400000], [470000, 500000], [570000, 600000], [670000, 700000], [770000, 800000]],
+}
+
+
+def source_signature(paths):
+    """Size and modification time of the raw files, a changed file invalidates the prepared arrays."""
+    return {os.path.basename(p): {'size': os.path.getsize(p), 'mtime_ns': os.stat(p).st_mtime_ns} for p in paths}
+
+
+def make_manifest(x_path, y_path, sampling=SAMPLING, weighted=False):
+    # JSON round trip, so that it compares equal to a manifest read back from disk
+    return json.loads(json.dumps({'version': 1, 'source': source_signature([x_path, y_path]), 'sampling': sampling,
+                                  'weighted': weighted}))
+
+
+def resample_split(normalized_X, y, sampling=SAMPLING):
+    """
+    Under/over-sampling of the classes and train/test split of SecFedNIDS.
+
+    Returns
+    -------
+    np_features_train, np_label_train, np_features_test, np_label_test : np.ndarray
+        features of shape (n, 1, features)
+    """
+    print('y', sorted(Counter(y).items()))
+    downsampling = RandomUnderSampler(sampling_strategy=sampling['under'], random_state=sampling['random_state'])
+    X_down, y_down = downsampling.fit_resample(normalized_X, y)
+    upsampling = RandomOverSampler(sampling_strategy=sampling['over'], random_state=sampling['random_state'])
+    Xt, yt = upsampling.fit_resample(X_down, y_down)
+    print('transformed y', sorted(Counter(yt).items()))
+    df = pd.DataFrame(Xt, index=yt)
+    ### dropna
+    df.dropna(axis=0, how='any', inplace=True)
+    df.sort_index(ascending=True, inplace=True)
+    split = dict()
+    for part in ('train', 'test'):
+        df_part = pd.concat([df.iloc[start:stop] for start, stop in sampling[part]])
+        df_part = shuffle(df_part)
+        split[part] = (df_part.values[:, np.newaxis, :], df_part.index.values.ravel())
+    return split['train'][0], split['train'][1], split['test'][0], split['test'][1]
+
+
+def resample_split_weighted(normalized_X, y, sampling=SAMPLING):
+    """
+    resample_split without the copies of RandomOverSampler: every distinct row is kept once
+    with the number of copies the over-sampling would have made as its integer weight.
+
+    The train/test ranges of SAMPLING are applied to the label-sorted rows expanded by their
+    weights, a row crossing a range boundary is kept on both sides with the weight of its
+    copies on each side, so the class totals of both parts are those of resample_split.
+
+    Returns
+    -------
+    np_features_train, np_label_train, np_features_test, np_label_test, np_weight_train, np_weight_test : np.ndarray
+    """
+    print('y', sorted(Counter(y).items()))
+    downsampling = RandomUnderSampler(sampling_strategy=sampling['under'], random_state=sampling['random_state'])
+    X_down, y_down = downsampling.fit_resample(normalized_X, y)
+    # over-sampling of the row numbers only, same draws as over-sampling the features
+    upsampling = RandomOverSampler(sampling_strategy=sampling['over'], random_state=sampling['random_state'])
+    upsampling.fit_resample(np.arange(len(y_down)).reshape(-1, 1), y_down)
+    weight = np.bincount(upsampling.sample_indices_, minlength=len(y_down))
+    weight[np.isnan(X_down).any(axis=1)] = 0
+    print('transformed y', sorted(Counter(y_down).items()), 'weighted',
+          sorted((int(c), int(weight[y_down == c].sum())) for c in np.unique(y_down)))
+    order = np.argsort(y_down, kind='stable')
+    order = order[weight[order] > 0]
+    stop = np.cumsum(weight[order])
+    start = stop - weight[order]
+    split = list()
+    for part in ('train', 'test'):
+        part_weight = np.zeros(len(order), dtype=np.int64)
+        for low, high in sampling[part]:
+            part_weight += np.clip(np.minimum(stop, high) - np.maximum(start, low), 0, None)
+        rows = order[part_weight > 0]
+        x_part, y_part, w_part = shuffle(X_down[rows], y_down[rows], part_weight[part_weight > 0])
+        split.append((x_part[:, np.newaxis, :], y_part, w_part))
+    return split[0][0], split[0][1], split[1][0], split[1][1], split[0][2], split[1][2]
+
+
+def load_prepared(cache_dir, manifest):
+    """
+    Parameters
+    ----------
+    cache_dir : str
+    manifest : dict
+        output of make_manifest for the current raw files and sampling
+
+    Returns
+    -------
+     : tuple of np.memmap or None
+        x_train, y_train, x_test, y_test (and w_train, w_test for a weighted manifest) opened
+        copy-on-write (no read, no copy until
+        touched, in-place edits stay private to the process), None if the directory holds
+        no prepared dataset for this manifest
+    """
+    path = os.path.join(cache_dir, MANIFEST)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        stored = json.load(f)
+    if {k: stored.get(k) for k in manifest} != manifest:
+        return None
+    try:
+        names = WEIGHTED_ARRAYS if manifest.get('weighted') else ARRAYS
+        arrays = tuple(np.load(os.path.join(cache_dir, name + '.npy'), mmap_mode='c') for name in names)
+    except (OSError, ValueError):
+        return None
+    if [list(a.shape) for a in arrays] != stored['shapes']:
+        return None
+    return arrays
+
+
+def save_prepared(cache_dir, manifest, arrays):
+    """
+    Writes the arrays as .npy files, then the manifest, so an interrupted prepare never leaves
+    a manifest pointing at incomplete files.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    path = os.path.join(cache_dir, MANIFEST)
+    if os.path.exists(path):
+        os.remove(path)
+    for name, array in zip(WEIGHTED_ARRAYS if manifest.get('weighted') else ARRAYS, arrays):
+        tmp = os.path.join(cache_dir, name + '.tmp.npy')
+        np.save(tmp, np.ascontiguousarray(array))
+        os.replace(tmp, os.path.join(cache_dir, name + '.npy'))
+    stored = dict(manifest, shapes=[list(a.shape) for a in arrays], dtypes=[str(a.dtype) for a in arrays])
+    with open(path + '.tmp', 'w') as f:
+        json.dump(stored, f, indent=1)
+    os.replace(path + '.tmp', path)
+
+
+def open_dataset(x_path='X.npy', y_path='Y_attack.npy', cache_dir=None, sampling=SAMPLING, weighted=False):
+    """
+    Prepared train/test arrays, memory-mapped from cache_dir when it holds them for the same raw
+    files and sampling, otherwise resampled from the raw files (and saved to cache_dir if given).
+    The weighted arrays live in the subdirectory 'weighted' of cache_dir.
+
+    Returns
+    -------
+    np_features_train, np_label_train, np_features_test, np_label_test : np.ndarray
+        followed by np_weight_train, np_weight_test if weighted, see resample_split_weighted
+    """
+    manifest = make_manifest(x_path, y_path, sampling, weighted)
+    if cache_dir is not None and weighted:
+        cache_dir = os.path.join(cache_dir, 'weighted')
+    if cache_dir is not None:
+        arrays = load_prepared(cache_dir, manifest)
+        if arrays is not None:
+            print('prepared dataset', cache_dir)
+            return arrays
+    resample = resample_split_weighted if weighted else resample_split
+    arrays = resample(np.load(x_path), np.load(y_path), sampling)
+    if cache_dir is None:
+        return arrays
+    save_prepared(cache_dir, manifest, arrays)
+    print('prepared dataset saved to', cache_dir)
+    return load_prepared(cache_dir, manifest)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Resample and split X.npy / Y_attack.npy once for later runs')
+    parser.add_argument('--x', type=str, default='X.npy', help="normalized features")
+    parser.add_argument('--y', type=str, default='Y_attack.npy', help="attack category labels")
+    parser.add_argument('--cache_dir', type=str, default='prepared', help="output directory of the prepared arrays")
+    parser.add_argument('--weighted', action='store_true', help="distinct rows with multiplicity weights")
+    args = parser.parse_args()
+    open_dataset(args.x, args.y, cache_dir=args.cache_dir, weighted=args.weighted)
@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+# @File    : evaluation.py
+
+from collections import OrderedDict
+import numpy as np
+import torch
+from sklearn.metrics import classification_report
+from precision import autocast
+
+
+class Evaluator:
+    """
+    Binary evaluation of models on a fixed test set.
+
+    The features are converted once per dtype into a contiguous tensor and the labels once
+    to 0 (normal) / 1 (attack), the caller's arrays are never modified. Batches run under
+    torch.inference_mode, predictions and per-row losses go into arrays allocated once and
+    the confusion matrix is a bincount. With weights, every row counts as many times as its
+    weight in the loss, the accuracy and the report. precision='bfloat16' autocasts the forward
+    passes like the training.
+
+    test_loss keeps the definition of the former DataLoader loop: the sum of the mean losses
+    of consecutive blocks of loss_block rows, divided by the total, so it stays comparable
+    whatever batch_size is.
+
+    evaluate_many scores several models of the same architecture in one pass over the test
+    set, e.g. the outputs of the aggregation backends or of a sweep of filter thresholds.
+    """
+
+    def __init__(self, x, y, weights=None, batch_size=8192, loss_block=32, precision='float32',
+                 device=torch.device('cpu')):
+        """
+        Parameters
+        ----------
+        x : array-like
+            (n, ...) test features
+        y : array-like
+            (n,) class of every row, every class but 0 counts as an attack
+        weights : array-like, optional
+            (n,) multiplicity of the rows
+        batch_size : int
+            rows per forward pass
+        loss_block : int
+            rows of the blocks test_loss averages over (test_BatchSize)
+        precision : str
+            one of precision.PRECISIONS
+        device : torch.device
+        """
+        self._x = np.ascontiguousarray(x)
+        self.y = torch.as_tensor(np.asarray(y) != 0, dtype=torch.long)
+        self.weights = None if weights is None else torch.as_tensor(np.asarray(weights), dtype=torch.float64)
+        # integer weights give an integer confusion matrix, like sklearn
+        self._integral = weights is None or np.issubdtype(np.asarray(weights).dtype, np.integer)
+        self.batch_size = batch_size
+        self.loss_block = loss_block
+        self.precision = precision
+        self.device = device
+        self._features = dict()
+        self._pred = torch.empty(len(self.y), dtype=torch.long)
+        self._loss = torch.empty(len(self.y), dtype=torch.float64)
+        self._models = dict()
+        self.total = len(self.y) if self.weights is None else float(self.weights.sum())
+
+    def __len__(self):
+        return len(self.y)
+
+    def features(self, dtype):
+        """the test features as one contiguous tensor of dtype on the device, converted once"""
+        if dtype not in self._features:
+            self._features[dtype] = torch.as_tensor(self._x).to(self.device, dtype).contiguous()
+        return self._features[dtype]
+
+    def predict(self, net):
+        """
+        Returns
+        -------
+        pred : torch.Tensor
+            (n,) predicted class of every row, a view of a buffer reused by the next call
+        loss : torch.Tensor
+            (n,) cross entropy of every row, reused likewise
+        """
+        x = self.features(next(net.parameters()).dtype)
+        y = self.y.to(self.device)
+        with torch.inference_mode(), autocast(self.precision, self.device):
+            for start in range(0, len(x), self.batch_size):
+                stop = min(start + self.batch_size, len(x))
+                scores = net(x[start:stop])
+                self._pred[start:stop] = scores.argmax(1).cpu()
+                self._loss[start:stop] = torch.nn.functional.cross_entropy(scores, y[start:stop],
+                                                                           reduction='none').cpu()
+        return self._pred, self._loss
+
+    def confusion_matrix(self, pred):
+        """(2, 2) confusion matrix, rows true classes, columns predicted classes, weighted if weights"""
+        cm = torch.bincount(self.y * 2 + pred, weights=self.weights, minlength=4).reshape(2, 2).numpy()
+        return cm.astype(np.int64) if self._integral else cm
+
+    def _test_loss(self, loss):
+        # sum over the blocks of loss_block rows of their (weighted) mean loss
+        starts = np.arange(0, len(loss), self.loss_block)
+        loss = loss.numpy()
+        if self.weights is None:
+            return float(np.sum(np.add.reduceat(loss, starts) / np.diff(np.append(starts, len(loss)))))
+        weights = self.weights.numpy()
+        return float(np.sum(np.add.reduceat(loss * weights, starts) / np.add.reduceat(weights, starts)))
+
+    def evaluate(self, net, verbose=True):
+        """
+        Parameters
+        ----------
+        net : torch.nn.Module
+            evaluated as it is, in its current train/eval mode
+        verbose : bool
+            print the classification report, the confusion matrix and the accuracy
+
+        Returns
+        -------
+        accuracy : float
+            percentage of correctly classified rows
+        test_loss : float
+        """
+        pred, loss = self.predict(net)
+        return self._report(pred, loss, verbose)
+
+    def _report(self, pred, loss, verbose):
+        cm = self.confusion_matrix(pred)
+        correct = cm[0, 0] + cm[1, 1]
+        test_loss = self._test_loss(loss)
+        if verbose:
+            print(classification_report(self.y.numpy(), pred.numpy(), sample_weight=None if self.weights is None
+                                        else self.weights.numpy()))
+            print(cm)
+            print('test_loss', test_loss)
+        test_loss /= self.total
+        accuracy = 100.00 * correct / self.total
+        if verbose:
+            print('\nTest set: Average loss: {:.4f} \nAccuracy: {}/{} ({:.2f}%)\n'.format(
+                test_loss, correct, self.total, accuracy))
+        return accuracy, test_loss
+
+    def evaluate_state_dict(self, state_dict, model_fn, verbose=True):
+        """
+        evaluate() of the weights state_dict, loaded into an eval-mode model_fn() built on the
+        first call and kept for the next calls with the same model_fn and dtype
+        """
+        net = self._model(model_fn, next(iter(state_dict.values())).dtype)
+        net.load_state_dict(state_dict)
+        return self.evaluate(net, verbose=verbose)
+
+    def _model(self, model_fn, dtype, i=0):
+        # eval-mode models built once, i-th of them for evaluate_many
+        key = (model_fn, dtype, i)
+        if key not in self._models:
+            self._models[key] = model_fn().to(self.device, dtype).eval()
+        return self._models[key]
+
+    def predict_many(self, state_dicts, model_fn):
+        """
+        Every test batch is sliced once and goes through all the models before the next one.
+        The models run one after the other on the batch: stacking them with torch.func.vmap
+        is several times slower on CPU, its batched max pooling falls back to a slow kernel.
+
+        Parameters
+        ----------
+        state_dicts : list of dict
+            weights of model_fn() models, all with the same dtype
+        model_fn : callable
+            builds the architecture, e.g. CNN_UNSW
+
+        Returns
+        -------
+        pred : torch.Tensor
+            (len(state_dicts), n) predicted class of every model and row
+        loss : torch.Tensor
+            (len(state_dicts), n) cross entropy of every model and row
+        """
+        dtype = next(iter(state_dicts[0].values())).dtype
+        nets = list()
+        for i, state_dict in enumerate(state_dicts):
+            nets.append(self._model(model_fn, dtype, i))
+            nets[-1].load_state_dict(state_dict)
+        x = self.features(dtype)
+        y = self.y.to(self.device)
+        num_models = len(state_dicts)
+        pred = torch.empty((num_models, len(x)), dtype=torch.long)
+        loss = torch.empty((num_models, len(x)), dtype=torch.float64)
+        with torch.inference_mode(), autocast(self.precision, self.device):
+            for start in range(0, len(x), self.batch_size):
+                stop = min(start + self.batch_size, len(x))
+                batch = x[start:stop]
+                scores = torch.stack([net(batch) for net in nets])
+                pred[:, start:stop] = scores.argmax(2).cpu()
+                loss[:, start:stop] = torch.nn.functional.cross_entropy(
+                    scores.flatten(0, 1), y[start:stop].repeat(num_models), reduction='none').view(num_models, -1).cpu()
+        return pred, loss
+
+    def evaluate_many(self, state_dicts, model_fn, verbose=True):
+        """
+        evaluate() of several weights of the same architecture in a single pass, see predict_many.
+
+        Parameters
+        ----------
+        state_dicts : dict
+            name -> state_dict
+        model_fn : callable
+        verbose : bool
+            print the report of every model under its name
+
+        Returns
+        -------
+         : OrderedDict
+            name -> (accuracy, test_loss)
+        """
+        names = list(state_dicts)
+        pred, loss = self.predict_many([state_dicts[name] for name in names], model_fn)
+        results = OrderedDict()
+        for i, name in enumerate(names):
+            if verbose:
+                print('########### Evaluation of', name)
+            results[name] = self._report(pred[i], loss[i], verbose)
+        return results
@@ -4,6 +4,7 @@
 # @File    : hprofile.py
 
 from collections import Counter, defaultdict
+from itertools import chain
 import numpy as np
 import copy
 
@@ -111,6 +112,317 @@ class Profile:
         return self
 
 
+class CompactProfile:
+    """
+    Array-backed counterpart of Profile.
+
+    Neuron counts are stored per layer as a dense count vector indexed by neuron id,
+    synapse counts as a (keys, counts) pair of arrays and synapse sets as an array of
+    unique rows. Merging profiles is a vector add and total/size are cached, which
+    keeps the aggregation of many single-input profiles free of per-neuron Python objects.
+
+    Note
+    ----
+    Neuron ids must be non-negative integers and synapses tuples of integers of the same
+    length within a layer. Counter entries with a count of 0 are not kept.
+    """
+
+    __slots__ = ('_neuron_counts', '_synapse_counts', '_synapse_weights', '_num_inputs', '_total', '_size')
+
+    def __init__(self, neuron_counts=None, synapse_counts=None, synapse_weights=None, num_inputs=0):
+        """
+        Parameters
+        ----------
+        neuron_counts : dict, optional
+            layer -> 1d integer array, entry n is the count of neuron n
+        synapse_counts : dict, optional
+            layer -> (keys, counts) with keys an (m, k) integer array of unique synapses and counts of shape (m,)
+        synapse_weights : dict, optional
+            layer -> (m, k) integer array of unique synapses
+        num_inputs : int, optional
+            Number of inputs represented by the profile
+        """
+        self._neuron_counts = {layer: np.asarray(counts, dtype=np.int64)
+                               for layer, counts in (neuron_counts or {}).items()}
+        self._synapse_counts = {layer: (np.asarray(keys, dtype=np.int64), np.asarray(counts, dtype=np.int64))
+                                for layer, (keys, counts) in (synapse_counts or {}).items()}
+        self._synapse_weights = {layer: np.asarray(keys, dtype=np.int64)
+                                 for layer, keys in (synapse_weights or {}).items()}
+        self._num_inputs = num_inputs
+        self._total = int(sum(counts.sum() for counts in self._neuron_counts.values()))
+        self._size = int(sum(np.count_nonzero(counts) for counts in self._neuron_counts.values()))
+
+    @classmethod
+    def from_profile(cls, profile):
+        """
+        Parameters
+        ----------
+        profile : Profile
+            neuron_counts, synapse_counts and synapse_weights in the defaultdict(Counter) / defaultdict(set) form
+
+        Returns
+        -------
+         : CompactProfile
+        """
+        neuron_counts = dict()
+        for layer, counter in profile.neuron_counts.items():
+            neurons = np.fromiter(counter.keys(), dtype=np.int64, count=len(counter))
+            counts = np.fromiter(counter.values(), dtype=np.int64, count=len(counter))
+            vector = np.zeros(neurons.max() + 1 if len(neurons) > 0 else 0, dtype=np.int64)
+            vector[neurons] = counts
+            neuron_counts[layer] = vector
+        synapse_counts = dict()
+        for layer, counter in profile.synapse_counts.items():
+            keys = [key for key, count in counter.items() if count != 0]
+            synapse_counts[layer] = (_synapse_array(keys),
+                                     np.array([counter[key] for key in keys], dtype=np.int64))
+        synapse_weights = {layer: _synapse_array(list(synapses))
+                           for layer, synapses in profile.synapse_weights.items()}
+        return cls(neuron_counts=neuron_counts, synapse_counts=synapse_counts,
+                   synapse_weights=synapse_weights, num_inputs=profile.num_inputs)
+
+    @classmethod
+    def from_indices(cls, indices, num_inputs=1):
+        """
+        Build a profile from the critical neurons of each layer, every index counted once.
+
+        Parameters
+        ----------
+        indices : dict
+            layer -> iterable of neuron ids
+        num_inputs : int, optional
+
+        Returns
+        -------
+         : CompactProfile
+        """
+        return cls(neuron_counts={layer: np.bincount(np.asarray(list(ids), dtype=np.int64))
+                                  for layer, ids in indices.items()},
+                   num_inputs=num_inputs)
+
+    def to_profile(self):
+        """
+        Returns
+        -------
+         : Profile
+            the equivalent dictionary backed profile
+        """
+        neuron_counts = defaultdict(Counter)
+        for layer, counts in self._neuron_counts.items():
+            neurons = np.flatnonzero(counts)
+            neuron_counts[layer] = Counter(dict(zip(neurons.tolist(), counts[neurons].tolist())))
+        synapse_counts = defaultdict(Counter)
+        for layer, (keys, counts) in self._synapse_counts.items():
+            synapse_counts[layer] = Counter(dict(zip(map(tuple, keys.tolist()), counts.tolist())))
+        synapse_weights = defaultdict(set)
+        for layer, keys in self._synapse_weights.items():
+            synapse_weights[layer] = set(map(tuple, keys.tolist()))
+        return Profile(neuron_counts=neuron_counts, synapse_counts=synapse_counts,
+                       synapse_weights=synapse_weights, num_inputs=self._num_inputs)
+
+    @property
+    def neuron_counts(self):
+        return self._neuron_counts
+
+    @property
+    def synapse_counts(self):
+        return self._synapse_counts
+
+    @property
+    def synapse_weights(self):
+        return self._synapse_weights
+
+    @property
+    def num_inputs(self):
+        return self._num_inputs
+
+    @property
+    def total(self):
+        return self._total
+
+    @property
+    def size(self):
+        return self._size
+
+    def neurons(self, layer):
+        """
+        Returns
+        -------
+         : numpy.ndarray
+            ids of the neurons with a non-zero count in layer
+        """
+        return np.flatnonzero(self._neuron_counts.get(layer, np.zeros(0, dtype=np.int64)))
+
+    def __eq__(self, other):
+        if not isinstance(other, CompactProfile):
+            return NotImplemented
+        return self.to_profile() == other.to_profile()
+
+    def __iter__(self):
+        return iter(self._neuron_counts.keys())
+
+    def __add__(self, other):
+        new_profile = CompactProfile(neuron_counts={layer: counts.copy()
+                                                    for layer, counts in self._neuron_counts.items()},
+                                     synapse_counts=self._synapse_counts,
+                                     synapse_weights=self._synapse_weights,
+                                     num_inputs=self._num_inputs)
+        new_profile += other
+        return new_profile
+
+    def __iadd__(self, other):
+        """
+        Adds in place the count vectors and synapse sets of other to self.
+
+        Parameters
+        ----------
+        other : CompactProfile
+
+        Returns
+        -------
+        self : CompactProfile
+        """
+        for layer, counts in other.neuron_counts.items():
+            # same layer keys as Profile.__iadd__, which touches every defaultdict for the layers of other
+            self._synapse_counts.setdefault(layer, (_synapse_array([]), np.zeros(0, dtype=np.int64)))
+            self._synapse_weights.setdefault(layer, _synapse_array([]))
+            mine = self._neuron_counts.get(layer)
+            if mine is None:
+                self._neuron_counts[layer] = counts.copy()
+                self._size += int(np.count_nonzero(counts))
+                continue
+            if len(mine) < len(counts):
+                mine = np.pad(mine, (0, len(counts) - len(mine)))
+            self._size -= int(np.count_nonzero(mine))
+            mine[:len(counts)] += counts
+            self._size += int(np.count_nonzero(mine))
+            self._neuron_counts[layer] = mine
+        self._total += other.total
+        for layer, (keys, counts) in other.synapse_counts.items():
+            if layer in self._synapse_counts and len(self._synapse_counts[layer][0]) > 0 and len(keys) > 0:
+                my_keys, my_counts = self._synapse_counts[layer]
+                keys, inverse = np.unique(np.concatenate((my_keys, keys)), axis=0, return_inverse=True)
+                counts = np.bincount(inverse.reshape(-1), weights=np.concatenate((my_counts, counts)),
+                                     minlength=len(keys)).astype(np.int64)
+            elif layer in self._synapse_counts and len(keys) == 0:
+                continue
+            self._synapse_counts[layer] = (keys, counts)
+        for layer, keys in other.synapse_weights.items():
+            if layer in self._synapse_weights and len(self._synapse_weights[layer]) > 0 and len(keys) > 0:
+                keys = np.unique(np.concatenate((self._synapse_weights[layer], keys)), axis=0)
+            elif layer in self._synapse_weights and len(keys) == 0:
+                continue
+            self._synapse_weights[layer] = keys
+        self._num_inputs += other.num_inputs
+        return self
+
+
+class ClassPathAccumulator:
+    """
+    Per-class neuron frequencies of critical paths.
+
+    Every class holds one CompactProfile whose count vectors are incremented once per
+    added sample, so building the class paths is linear in the number of samples and
+    partial accumulators (e.g. from different clients or workers) merge by vector add.
+    """
+
+    def __init__(self):
+        self._profiles = dict()
+
+    @property
+    def classes(self):
+        return sorted(self._profiles.keys())
+
+    def profile(self, cls):
+        """
+        Returns
+        -------
+         : CompactProfile
+            accumulated counts of class cls
+        """
+        return self._profiles.setdefault(cls, CompactProfile())
+
+    def add(self, cls, path):
+        """
+        Parameters
+        ----------
+        cls : int
+            class of the sample
+        path : dict
+            layer -> iterable of the critical neuron ids of the sample
+        """
+        self.add_batch([cls], {layer: [ids] for layer, ids in path.items()})
+
+    def add_batch(self, labels, sample_paths):
+        """
+        Parameters
+        ----------
+        labels : array-like
+            (N,) class of each sample
+        sample_paths : dict
+            layer -> list of per-sample iterables of neuron ids, N samples in every layer
+        """
+        labels = np.asarray(labels)
+        for cls in np.unique(labels).tolist():
+            rows = np.flatnonzero(labels == cls)
+            counts = dict()
+            for layer, paths in sample_paths.items():
+                ids = [np.fromiter(paths[i], dtype=np.int64) for i in rows]
+                counts[layer] = np.bincount(np.concatenate(ids))
+            self.profile(cls).__iadd__(CompactProfile(neuron_counts=counts, num_inputs=len(rows)))
+
+    def merge(self, other):
+        """
+        Adds the counts of another accumulator to self.
+
+        Parameters
+        ----------
+        other : ClassPathAccumulator
+
+        Returns
+        -------
+        self : ClassPathAccumulator
+        """
+        for cls in other.classes:
+            self.profile(cls).__iadd__(other.profile(cls))
+        return self
+
+    def __iadd__(self, other):
+        return self.merge(other)
+
+    def counts(self, cls, layer):
+        """
+        Returns
+        -------
+         : numpy.ndarray
+            count vector of layer for class cls, entry n is the number of samples with neuron n in their path
+        """
+        return self.profile(cls).neuron_counts.get(layer, np.zeros(0, dtype=np.int64))
+
+    def most_common(self, cls, layer, k):
+        """
+        Equivalent of Counter.most_common on the neuron counts of one class and layer,
+        ties are broken by the smaller neuron id.
+
+        Returns
+        -------
+         : list
+            at most k (neuron, count) tuples ordered by decreasing count
+        """
+        counts = self.counts(cls, layer)
+        top = np.flatnonzero(counts)
+        if k <= 0:
+            return []
+        top = top[np.lexsort((top, -counts[top]))][:k]
+        return list(zip(top.tolist(), counts[top].tolist()))
+
+
+def _synapse_array(synapses):
+    if len(synapses) == 0:
+        return np.zeros((0, 0), dtype=np.int64)
+    return np.array(synapses, dtype=np.int64).reshape(len(synapses), -1)
+
+
 def jaccard_simple(set1, set2):
     """
     Computes the jaccard similarity of two sets = size of their
@@ -132,6 +444,117 @@ def jaccard_simple(set1, set2):
     return len(s1 & s2) / len(s1 | s2)
 
 
+def path_mask(paths, width):
+    """
+    Encodes a batch of neuron paths as a boolean matrix.
+
+    Parameters
+    ----------
+    paths : list of iterables
+        neuron ids of one layer, one iterable per sample
+    width : int
+        number of neurons in the layer, must exceed every id
+
+    Returns
+    -------
+    mask : numpy.ndarray
+        (len(paths), width) boolean array, mask[i, n] is True if neuron n is in paths[i]
+    """
+    paths = [np.fromiter(path, dtype=np.int64) for path in paths]
+    mask = np.zeros((len(paths), width), dtype=bool)
+    if len(paths) > 0:
+        rows = np.repeat(np.arange(len(paths)), [len(path) for path in paths])
+        mask[rows, np.concatenate(paths)] = True
+    return mask
+
+
+def batch_jaccard(mask1, mask2):
+    """
+    Row-wise jaccard_simple of two boolean path matrices.
+
+    Parameters
+    ----------
+    mask1 : numpy.ndarray
+        (N, width) boolean array
+    mask2 : numpy.ndarray
+        (N, width) or (width,) boolean array
+
+    Returns
+    -------
+     : numpy.ndarray
+        (N,) IOU of the rows, 0 where either set is empty
+    """
+    intersection = np.count_nonzero(mask1 & mask2, axis=-1)
+    union = np.count_nonzero(mask1 | mask2, axis=-1)
+    nonempty = mask1.any(axis=-1) & mask2.any(axis=-1)
+    return np.where(nonempty, intersection / np.maximum(union, 1), 0.)
+
+
+class ClassPathScorer:
+    """
+    Scores batches of sample paths against fixed class paths.
+
+    The class paths are encoded once per layer, each call then computes the IOU of every
+    sample with the path of its class with a few array operations instead of one
+    jaccard_simple call per sample and layer.
+    """
+
+    def __init__(self, class_paths):
+        """
+        Parameters
+        ----------
+        class_paths : dict
+            class -> layer -> iterable of neuron ids (e.g. the most_common neurons of the class)
+        """
+        self.classes = sorted(class_paths.keys())
+        self.layers = sorted(set(chain(*[class_paths[cls].keys() for cls in self.classes])))
+        self._class_index = {cls: i for i, cls in enumerate(self.classes)}
+        self._paths = {layer: [np.unique(np.fromiter(class_paths[cls].get(layer, []), dtype=np.int64))
+                               for cls in self.classes]
+                       for layer in self.layers}
+
+    def class_positions(self, labels):
+        """
+        Returns
+        -------
+         : numpy.ndarray
+            position of every label in self.classes
+        """
+        return np.array([self._class_index[label] for label in np.asarray(labels).tolist()], dtype=np.int64)
+
+    def layer_ious(self, sample_paths, labels):
+        """
+        Parameters
+        ----------
+        sample_paths : dict
+            layer -> list of per-sample iterables of neuron ids, N samples in every layer
+        labels : array-like
+            (N,) class of each sample
+
+        Returns
+        -------
+        ious : numpy.ndarray
+            (N, len(self.layers)) IOU of each sample path with its class path at each layer
+        """
+        positions = self.class_positions(labels)
+        ious = np.zeros((len(positions), len(self.layers)))
+        for j, layer in enumerate(self.layers):
+            paths = [np.fromiter(path, dtype=np.int64) for path in sample_paths[layer]]
+            width = 1 + max([path.max() for path in self._paths[layer] + paths if len(path) > 0] + [0])
+            class_mask = path_mask(self._paths[layer], width)
+            ious[:, j] = batch_jaccard(path_mask(paths, width), class_mask[positions])
+        return ious
+
+    def avg_ious(self, sample_paths, labels):
+        """
+        Returns
+        -------
+         : numpy.ndarray
+            (N,) mean IOU across self.layers, see layer_ious
+        """
+        return self.layer_ious(sample_paths, labels).mean(axis=1)
+
+
 def instance_jaccard(profile1, profile2, neuron=False):
     """
     Computes the proportion of synapses(or neurons/neurons) of profile1 that
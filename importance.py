@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+# @File    : importance.py
+
+from collections import OrderedDict
+import numpy as np
+import torch
+
+
+def flat_slices(named_tensors):
+    """
+    Parameters
+    ----------
+    named_tensors : iterable of (name, tensor)
+        e.g. model.named_parameters()
+
+    Returns
+    -------
+     : OrderedDict
+        name -> slice of the tensor in the concatenation of all of them
+    """
+    slices = OrderedDict()
+    offset = 0
+    for n, t in named_tensors:
+        slices[n] = slice(offset, offset + t.numel())
+        offset += t.numel()
+    return slices
+
+
+def consolidate_flat(current, weight, mean_pre, epsilon, out=None, scratch=None):
+    """
+    omega = max(weight, 0) / ((current - mean_pre) ** 2 + epsilon) over flat parameter vectors.
+
+    Computed in place in out (a new tensor if None) with scratch as the only temporary, so a
+    caller with preallocated buffers allocates nothing.
+    """
+    out = torch.sub(current, mean_pre, out=out)
+    out.square_().add_(epsilon)
+    scratch = torch.clamp(weight, min=0, out=scratch)
+    return torch.div(scratch, out, out=out)
+
+
+def layer_topk(numel):
+    """Important parameters kept per layer: 100 for layers with more than 1000 parameters, 10% otherwise."""
+    if numel > 1000:
+        return 100
+    return int(0.1 * numel)
+
+
+def select_topk(omega, slices, policy='layer', k=None):
+    """
+    Indices of the most important parameters.
+
+    Parameters
+    ----------
+    omega : torch.Tensor
+        flat importance vector, see consolidate_flat
+    slices : dict
+        parameter name -> slice of omega, see flat_slices
+    policy : str
+        'layer': top layer_topk(numel) of every layer, the rule of the paper.
+        'global': top k of the whole model, split by layer afterwards
+    k : int, optional
+        budget of the 'global' policy, the total of the 'layer' policy by default
+
+    Returns
+    -------
+    omega_index : dict
+        parameter name -> int32 np.ndarray of indices within the layer, most important first
+    """
+    omega_index = {}
+    if policy == 'layer':
+        for n, s in slices.items():
+            omega_index[n] = torch.topk(omega[s], layer_topk(s.stop - s.start))[1].to(torch.int32).cpu().numpy()
+    elif policy == 'global':
+        if k is None:
+            k = sum(layer_topk(s.stop - s.start) for s in slices.values())
+        top = torch.topk(omega, min(k, len(omega)))[1].cpu().numpy()
+        for n, s in slices.items():
+            local = top[(top >= s.start) & (top < s.stop)] - s.start
+            omega_index[n] = local.astype(np.int32)
+    else:
+        raise ValueError(f'unknown top-k policy {policy}')
+    return omega_index
+
+
+class ImportanceTracker:
+    """
+    Synaptic-intelligence path importance accumulated from the optimizer steps.
+
+    Hooks into optimizer.step: before the step the current parameters are copied into
+    preallocated buffers, after the step w[n] -= grad * (p_new - p_old) is applied in
+    place with the first-order gradients left in p.grad by loss.backward(), so no extra
+    autograd.grad pass and no per-step parameter clones are needed. The buffers are views
+    of flat vectors, omega is computed over them in place at the end.
+    """
+
+    def __init__(self, model, optimizer):
+        """
+        Parameters
+        ----------
+        model : torch.nn.Module
+        optimizer : torch.optim.Optimizer
+            optimizer updating the parameters of model
+        """
+        self.model = model
+        self.slices = flat_slices(model.named_parameters())
+        first = next(model.parameters())
+        numel = sum(s.stop - s.start for s in self.slices.values())
+        self._mean_pre_flat = torch.cat([p.detach().reshape(-1) for p in model.parameters()])
+        self._w_flat = torch.zeros(numel, dtype=first.dtype, device=first.device)
+        self._old_par_flat = torch.zeros_like(self._w_flat)
+        views = lambda flat: {n: flat[s].view_as(p) for (n, p), s in zip(model.named_parameters(),
+                                                                           self.slices.values())}
+        self.mean_pre = views(self._mean_pre_flat)
+        self.w = views(self._w_flat)
+        self._old_par = views(self._old_par_flat)
+        self._handles = [optimizer.register_step_pre_hook(self._pre_step),
+                         optimizer.register_step_post_hook(self._post_step)]
+
+    def _pre_step(self, optimizer, args, kwargs):
+        with torch.no_grad():
+            for n, p in self.model.named_parameters():
+                self._old_par[n].copy_(p)
+
+    def _post_step(self, optimizer, args, kwargs):
+        with torch.no_grad():
+            for n, p in self.model.named_parameters():
+                if p.grad is None:
+                    continue
+                # old_par becomes p_old - p_new, then w += grad * (p_old - p_new)
+                self._old_par[n].sub_(p)
+                self.w[n].addcmul_(p.grad, self._old_par[n])
+
+    def consolidate_flat(self, epsilon=0.0001):
+        """
+        Returns
+        -------
+         : torch.Tensor
+            flat importance omega, laid out as self.slices. The old-parameter buffer is reused
+            as scratch, call it once training is over.
+        """
+        with torch.no_grad():
+            omega = torch.cat([p.detach().reshape(-1) for p in self.model.parameters()])
+            return consolidate_flat(omega, self._w_flat, self._mean_pre_flat, epsilon, out=omega,
+                                    scratch=self._old_par_flat)
+
+    def consolidate(self, epsilon=0.0001):
+        """
+        Returns
+        -------
+         : dict
+            parameter name -> importance omega, views of consolidate_flat
+        """
+        omega = self.consolidate_flat(epsilon)
+        return {n: omega[s].view_as(self.w[n]) for n, s in self.slices.items()}
+
+    def select(self, epsilon=0.0001, policy='layer', k=None):
+        """
+        Returns
+        -------
+        omega_index : dict
+            parameter name -> int32 indices of the important parameters, see select_topk
+        """
+        return select_topk(self.consolidate_flat(epsilon), self.slices, policy=policy, k=k)
+
+    def remove(self):
+        for handle in self._handles:
+            handle.remove()
+        self._handles = []
@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+# @File    : ingest.py
+
+import argparse
+import numpy as np
+import pandas as pd
+
+# attack_cat of UNSW-NB15 -> label of Y_attack.npy, the order of ids-unsw-nb15.ipynb
+ATTACK_CATEGORIES = ['Normal', 'Generic', 'Exploits', 'Fuzzers', 'DoS', 'Reconnaissance', 'Analysis', 'Backdoor',
+                     'Shellcode', 'Worms']
+DROP_COLUMNS = ['proto', 'service', 'state', 'label']
+LABEL_COLUMN = 'attack_cat'
+
+
+def encode_attack_cat(values, categories=ATTACK_CATEGORIES):
+    """
+    Vectorized attack_cat -> integer label, surrounding whitespace ignored.
+
+    Raises
+    ------
+    ValueError
+        on a category missing from categories
+    """
+    codes = pd.Categorical(pd.Series(values).astype(str).str.strip(), categories=categories).codes.astype(np.int64)
+    if (codes < 0).any():
+        unknown = sorted(set(pd.Series(values)[codes < 0].astype(str).str.strip()))
+        raise ValueError(f'unknown attack_cat {unknown}')
+    return codes
+
+
+def read_chunks(paths, chunksize=100000, drop_columns=DROP_COLUMNS, label_column=LABEL_COLUMN):
+    """
+    Yields (features, labels, columns) of every chunk of rows of the CSV files, in order.
+
+    features is a float64 (rows, features) array, labels the encoded attack_cat.
+    """
+    for path in paths:
+        for chunk in pd.read_csv(path, chunksize=chunksize):
+            chunk = chunk.drop(columns=[c for c in drop_columns if c in chunk.columns])
+            labels = encode_attack_cat(chunk.pop(label_column).values)
+            yield chunk.to_numpy(dtype=np.float64), labels, list(chunk.columns)
+
+
+class RunningMinMax:
+    """
+    MinMaxScaler fitted chunk by chunk: per-column minimum and maximum of everything seen,
+    transform maps them to [0, 1] and constant columns to 0 like sklearn.
+    """
+
+    def __init__(self):
+        self.data_min_ = None
+        self.data_max_ = None
+        self.n_samples_seen_ = 0
+
+    def partial_fit(self, X):
+        low = np.nanmin(X, axis=0)
+        high = np.nanmax(X, axis=0)
+        if self.data_min_ is None:
+            self.data_min_, self.data_max_ = low, high
+        else:
+            self.data_min_ = np.fmin(self.data_min_, low)
+            self.data_max_ = np.fmax(self.data_max_, high)
+        self.n_samples_seen_ += len(X)
+        return self
+
+    def transform(self, X, columns=slice(None)):
+        """Scales X, or the columns of the fitted data X holds."""
+        span = self.data_max_[columns] - self.data_min_[columns]
+        span = np.where(span == 0, 1., span)
+        return (X - self.data_min_[columns]) / span
+
+
+def oversample_index(class_rows, target_samples, seed=None):
+    """
+    Rows to duplicate so that every class of target_samples reaches its target, drawn with
+    replacement like RandomOverSampler.
+
+    Parameters
+    ----------
+    class_rows : dict
+        class -> np.ndarray of its row numbers
+    target_samples : dict
+        class -> number of rows wanted, classes already above their target are left as they are
+
+    Returns
+    -------
+     : np.ndarray
+        row numbers to append, grouped by class
+    """
+    rng = np.random.default_rng(seed)
+    extra = [rng.choice(class_rows[cls], target - len(class_rows[cls]), replace=True)
+             for cls, target in sorted(target_samples.items())
+             if cls in class_rows and len(class_rows[cls]) > 0 and target > len(class_rows[cls])]
+    return np.concatenate(extra) if len(extra) > 0 else np.zeros(0, dtype=np.int64)
+
+
+def ingest(paths, x_path='X.npy', y_path='Y_attack.npy', chunksize=100000, column_block=8, minmax=True,
+           target_samples=None, seed=None):
+    """
+    Streams UNSW-NB15 style CSVs into X.npy / Y_attack.npy with memory bounded by chunksize.
+
+    The first pass counts the rows of every class and fits the MinMax statistics, the second
+    writes the scaled features of every chunk column block by column block into the
+    memory-mapped X.npy. Rows added by target_samples are then copied block by block from the
+    written output. Only the row numbers of the classes are kept in memory.
+
+    Parameters
+    ----------
+    paths : list of str
+        CSV files, e.g. UNSW_NB15_training-set.csv and UNSW_NB15_testing-set.csv
+    x_path, y_path : str
+        outputs
+    chunksize : int
+        rows read at once
+    column_block : int
+        feature columns scaled and written at once
+    minmax : bool
+        scale the features to [0, 1]
+    target_samples : dict, optional
+        class -> rows of the output, random oversampling (the notebook ran SMOTE with {0: 400000, 1: 100000})
+    seed : int, optional
+        seed of the oversampling
+
+    Returns
+    -------
+    X, y : np.memmap
+    """
+    scaler = RunningMinMax()
+    labels = list()
+    columns = None
+    for features, chunk_labels, chunk_columns in read_chunks(paths, chunksize):
+        if columns is None:
+            columns = chunk_columns
+        elif chunk_columns != columns:
+            raise ValueError(f'columns of the CSV files differ: {chunk_columns} != {columns}')
+        scaler.partial_fit(features)
+        labels.append(chunk_labels.astype(np.int8))
+    labels = np.concatenate(labels).astype(np.int64)
+    n = len(labels)
+    order = np.argsort(labels, kind='stable')
+    counts = np.bincount(labels)
+    class_rows = {cls: rows for cls, rows in zip(range(len(counts)), np.split(order, np.cumsum(counts)[:-1]))}
+    extra = oversample_index(class_rows, target_samples or {}, seed=seed)
+    print('ingest', n, 'rows', len(columns), 'features', 'classes', dict(enumerate(counts.tolist())),
+          'oversampled', len(extra))
+
+    X = np.lib.format.open_memmap(x_path, mode='w+', dtype=np.float64, shape=(n + len(extra), len(columns)))
+    y = np.lib.format.open_memmap(y_path, mode='w+', dtype=np.int64, shape=(n + len(extra),))
+    start = 0
+    for features, _, _ in read_chunks(paths, chunksize):
+        stop = start + len(features)
+        for c in range(0, len(columns), column_block):
+            block = slice(c, min(c + column_block, len(columns)))
+            values = features[:, block]
+            X[start:stop, block] = scaler.transform(values, block) if minmax else values
+        start = stop
+    y[:n] = labels
+    for c in range(0, len(extra), chunksize):
+        rows = extra[c:c + chunksize]
+        # read the source rows in increasing order, then put them back in the order of rows
+        by_row = np.argsort(rows)
+        block = np.empty((len(rows), len(columns)), dtype=X.dtype)
+        block[by_row] = X[rows[by_row]]
+        X[n + c:n + c + len(rows)] = block
+        y[n + c:n + c + len(rows)] = labels[rows]
+    X.flush()
+    y.flush()
+    return X, y
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='UNSW-NB15 CSVs -> X.npy / Y_attack.npy in bounded memory')
+    parser.add_argument('csv', nargs='+', help="CSV files with an attack_cat column")
+    parser.add_argument('--x', type=str, default='X.npy', help="output features")
+    parser.add_argument('--y', type=str, default='Y_attack.npy', help="output labels")
+    parser.add_argument('--chunksize', type=int, default=100000, help="rows read at once")
+    parser.add_argument('--no_minmax', action='store_true', help="keep the raw feature values")
+    parser.add_argument('--target', type=str, default="0:400000,1:100000",
+                        help="class:rows of the random oversampling, '' for none")
+    parser.add_argument('--seed', type=int, default=None, help="seed of the oversampling")
+    args = parser.parse_args()
+    target = {int(k): int(v) for k, v in (item.split(':') for item in args.target.split(',') if item)}
+    ingest(args.csv, args.x, args.y, chunksize=args.chunksize, minmax=not args.no_minmax, target_samples=target,
+           seed=args.seed)
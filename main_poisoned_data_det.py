@@ -1,127 +1,54 @@
-import pandas as pd
 import numpy as np
-from sklearn.preprocessing import MinMaxScaler
 
 import torch
-from torch.utils.data import Dataset, DataLoader
-from torch.autograd import Variable
 from torch.nn.modules import activation, dropout, batchnorm
-from sklearn.utils import shuffle
 from sklearn.metrics import classification_report, confusion_matrix
 import copy
 from collections import Counter, defaultdict, deque, OrderedDict
-from collections.abc import Iterable
-from itertools import chain, combinations
-from pyod.models.sos import SOS
+from itertools import chain
 import argparse
+import ast
 from Net import CNN_UNSW
-from imblearn.over_sampling import RandomOverSampler
-from imblearn.under_sampling import RandomUnderSampler
-import math
 import inspect
 import warnings
 
 warnings.filterwarnings('ignore')
 import traceback
-from hprofile import Profile, jaccard_simple
-from utils import TorchHook, DDPCounter
+from hprofile import Profile, ClassPathScorer, ClassPathAccumulator
+from importance import ImportanceTracker
+from vmap_clients import VmapClientTrainer
+from precision import param_dtype, autocast, parity_check
+from dataset_cache import open_dataset
+from partition import PARTITIONS, class_combination_partition
+from aggregation import ClientUpdateStore, StreamingFedAvg, AGGREGATORS, aggregate
+from attacks import PoisoningScenario, MODEL_ATTACKS
+from evaluation import Evaluator
+from utils import TorchHook, DDPCounter, ProfileCache, model_fingerprint, ClientExecutor, BatchLoader, ShardRegistry
 
 device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
 
 
-# convert a list of list to a list [[],[],[]]->[,,]
-def flatten(items):
-    """Yield items from any nested iterable; see Reference."""
-    for x in items:
-        if isinstance(x, Iterable) and not isinstance(x, (str, bytes)):
-            for sub_x in flatten(x):
-                yield sub_x
-        else:
-            yield x
-
-
-def readdataset():
-    normalized_X = np.load('X.npy')
-    y = np.load('Y_attack.npy')
-    print('y', sorted(Counter(y).items()))
-
-    # downsampling = RandomUnderSampler(
-    #     sampling_strategy={0: 100000, 1: 100000, 2: 44525, 3: 24246, 4: 16353, 5: 13987, 6: 0, 7: 0, 8: 0, 9: 0},
-    #     random_state=0)
-    downsampling = RandomUnderSampler(
-        sampling_strategy={0: 400000, 1: 100000, 2: 44525, 3: 24246, 4: 16353, 5: 0, 6: 0, 7: 0, 8: 0, 9: 0},
-        random_state=0)
-    X_down, y_down = downsampling.fit_resample(normalized_X, y)
-    # upsampling = RandomOverSampler(
-    #     sampling_strategy={0: 100000, 1: 100000, 2: 100000, 3: 100000, 4: 100000, 5: 100000}, random_state=0)
-    upsampling = RandomOverSampler(
-        sampling_strategy={0: 400000, 1: 100000, 2: 100000, 3: 100000, 4: 100000}, random_state=0)
-    Xt, yt = upsampling.fit_resample(X_down, y_down)
-    print('transformed y', sorted(Counter(yt).items()))
-    df = pd.DataFrame(Xt, index=yt)
-    ### dropna
-    df.dropna(axis=0, how='any', inplace=True)
-    df.sort_index(ascending=True, inplace=True)
-    train0 = df.iloc[0:280000]
-    train1 = df.iloc[400000:400000 + 70000]
-    train2 = df.iloc[500000:500000 + 70000]
-    train3 = df.iloc[600000:600000 + 70000]
-    train4 = df.iloc[700000:700000 + 70000]
-    # train5 = df.iloc[500000:500000 + 70000]
-    df_train = pd.concat([train0, train1, train2, train3, train4])  # , train5
-    df_train = shuffle(df_train)
-    np_features_train = df_train.values
-    np_features_train = np_features_train[:, np.newaxis, :]
-    np_label_train = df_train.index.values.ravel()
+def readdataset(cache_dir=None, weighted=False):
+    ###### resampled and split once, memory-mapped from cache_dir by the following runs, see dataset_cache
+    ###### weighted: distinct rows with their number of over-sampled copies as weight, None otherwise
+    arrays = open_dataset('X.npy', 'Y_attack.npy', cache_dir=cache_dir, weighted=weighted)
+    np_features_train, np_label_train, np_features_test, np_label_test = arrays[:4]
+    np_weight_train, np_weight_test = arrays[4:] if weighted else (None, None)
     print('train', sorted(Counter(np_label_train).items()))
-
-    test0 = df.iloc[280000:400000]
-    test1 = df.iloc[400000 + 70000:400000 + 100000]
-    test2 = df.iloc[500000 + 70000:500000 + 100000]
-    test3 = df.iloc[600000 + 70000:600000 + 100000]
-    test4 = df.iloc[700000 + 70000:700000 + 100000]
-    # test5 = df.iloc[500000 + 70000:500000 + 100000]
-    df_test = pd.concat([test0, test1, test2, test3, test4])  # , test5
-    df_test = shuffle(df_test)
-    features_test = df_test.values
-
-    # dropna b~~~~ handle
-
-    np_features_test = np.array(features_test)
-
-    np_features_test = np_features_test[:, np.newaxis, :]
-    np_label_test = df_test.index.values.ravel()
     print('test', sorted(Counter(np_label_test).items()))
-    return np_features_train, np_label_train, np_features_test, np_label_test
+    if weighted:
+        print('weighted train', [(int(c), int(np_weight_train[np_label_train == c].sum())) for c in np.unique(np_label_train)])
+        print('weighted test', [(int(c), int(np_weight_test[np_label_test == c].sum())) for c in np.unique(np_label_test)])
+    return np_features_train, np_label_train, np_features_test, np_label_test, np_weight_train, np_weight_test
 
 
-class ReadData(Dataset):
-    def __init__(self, x_tra, y_tra):
+class ReadData:
+    ###### the training arrays the clients are partitioned from, their rows are read through utils.ShardRegistry
+    def __init__(self, x_tra, y_tra, w_tra=None):
         self.x_train = x_tra
         self.y_train = y_tra
-
-    def __len__(self):
-        return len(self.x_train)
-
-    def __getitem__(self, item):
-        image, label = self.x_train[item], self.y_train[item]
-        image = torch.from_numpy(image)
-        label = torch.from_numpy(np.asarray(label))
-        return image, label
-
-
-class DatasetSplit(Dataset):
-    def __init__(self, dataset, idxs):
-        self.dataset = dataset
-        self.idxs = list(idxs)
-        self.features, self.labels = self.dataset[self.idxs]
-
-    def __len__(self):
-        return len(self.idxs)
-
-    def __getitem__(self, item):
-        image, label = self.dataset[self.idxs[item]]
-        return image, label
+        ###### optional multiplicity of every row
+        self.w_train = w_tra
 
 
 class TorchProfiler():
@@ -144,7 +71,8 @@ class TorchProfiler():
                                   '_contrib_adaptive_avg_pool1d',
                                   '_contrib_conv1d']
 
-        self.model = TorchHook(model)
+        self.device = device
+        self.model = TorchHook(model, device=device)
         self.hooks = self.model.available_modules()
 
     def create_layers(self, nlayers=0):
@@ -202,29 +130,105 @@ class TorchProfiler():
         func = getattr(self.__class__, layerdict[ldx][1])
         return func(self, x_in, y_out, R, layers, threshold)
 
+    @staticmethod
+    def _topk_per_sample(Rx_sum, threshold):
+        # rank the neurons of every sample independently, K is relative to the width of one sample
+        # the indices stay on the device, _batch_profiles copies all layers to the host at once
+        Rx_sum = Rx_sum.reshape(Rx_sum.shape[0], -1)
+        K = int(threshold * Rx_sum.shape[1])
+        TOPK_value_index = torch.topk(Rx_sum, K, dim=1, sorted=True)
+        return TOPK_value_index[1]
+
+    @staticmethod
+    def _stabilize(Z, eps):
+        # Z + eps * sign(Z) with sign(0) = 1, in a single allocation
+        return torch.where(Z >= 0, Z + eps, Z - eps)
+
     def create_profile(self, x, layerdict, n_layers=0, threshold=0.5, show_progress=False, parallel=False):
-        x = x.to(device)
+        """
+        Profile a single input of shape (1, channels, length), see create_profiles for batches.
+        """
+        return self.create_profiles(x, layerdict, n_layers=n_layers, threshold=threshold,
+                                    batch_size=x.shape[0], show_progress=show_progress)[0]
+
+    def create_profiles(self, x, layerdict, n_layers=0, threshold=0.5, batch_size=1024, show_progress=False,
+                        cache=None):
+        """
+        Batched profiling: one forward pass and one chain of _contrib_* calls per batch.
+
+        Parameters
+        ----------
+        x : torch.Tensor
+            inputs of shape (N, channels, length)
+        layerdict : OrderedDict
+            output of create_layers
+        n_layers : int, optional
+            number of layers to profile, 0 for all of them
+        threshold : float, optional
+        batch_size : int, optional
+            number of rows propagated together, bounds the memory of the activations
+        show_progress : bool, optional
+        cache : utils.ProfileCache, optional
+            rows whose bytes were already profiled by the same weights are looked up instead of propagated,
+            duplicated rows share the same (read-only) Profile object
+
+        Returns
+        -------
+        profiles : list of Profile
+            one profile per row of x, identical to calling create_profile on that row alone
+        """
+        ###### a client with too few rows samples none of them
+        if x.shape[0] == 0:
+            return []
+        if cache is not None:
+            return self._cached_profiles(x, layerdict, n_layers, threshold, batch_size, show_progress, cache)
+        profiles = list()
+        for start in range(0, x.shape[0], batch_size):
+            profiles.extend(self._batch_profiles(x[start:start + batch_size], layerdict, n_layers, threshold,
+                                                 show_progress))
+        return profiles
+
+    def _cached_profiles(self, x, layerdict, n_layers, threshold, batch_size, show_progress, cache):
+        fingerprint = model_fingerprint(self.model.model)
+        rows = x.detach().cpu().reshape(x.shape[0], -1).numpy()
+        profiles = [None] * len(rows)
+        missing = OrderedDict()  # key -> positions of the rows sharing these bytes
+        for i, row in enumerate(rows):
+            key = cache.make_key(fingerprint, row, threshold, n_layers)
+            if key in missing:
+                missing[key].append(i)
+                continue
+            profiles[i] = cache.get(key)
+            if profiles[i] is None:
+                missing[key] = [i]
+        if len(missing) > 0:
+            first = torch.as_tensor([positions[0] for positions in missing.values()])
+            computed = self.create_profiles(x[first], layerdict, n_layers=n_layers, threshold=threshold,
+                                            batch_size=batch_size, show_progress=show_progress)
+            for (key, positions), profile in zip(missing.items(), computed):
+                cache.put(key, profile)
+                for i in positions:
+                    profiles[i] = profile
+        return profiles
+
+    def _batch_profiles(self, x, layerdict, n_layers, threshold, show_progress):
+        # R, Z, S and Rx never leave self.device, only the top-k indices are copied back once per batch
+        # relevance is propagated in the dtype of the profiled weights, never autocast
+        x = x.to(self.device, dtype=next(self.model.model.parameters()).dtype)
 
         with torch.no_grad():
             y, actives = self.model.forward(x)
 
-            neuron_counts = defaultdict(list)
-            synapse_counts = defaultdict(Counter)
-            synapse_weights = defaultdict(list)
-
-            # initialize profile with index of maximal logit from last layer
-            neuron = int((torch.argmax(y[0].cpu())).detach().numpy())
-            neuron_counts[0].append(neuron)
-            synapse_counts[0].update([(neuron, neuron, 0)])
-            synapse_weights[0].append(torch.max(y[0].cpu()))
-            mask = torch.zeros_like(y.cpu())
-            mask[:, torch.argmax(y.cpu())] = 1
-            R = y.cpu() * mask
+            # initialize profiles with index of maximal logit from last layer of every sample
+            y_max, neurons = torch.max(y, dim=1)
+            R = torch.zeros_like(y)
+            R.scatter_(1, neurons.unsqueeze(1), y_max.unsqueeze(1))
 
             if n_layers == 0 or n_layers >= len(layerdict):
                 n = len(layerdict)
             else:
                 n = n_layers + 1
+            batch_counts = OrderedDict()
             for ldx in range(1, n):
                 try:
                     if show_progress:
@@ -240,9 +244,7 @@ class TorchProfiler():
                     y_out = actives[layers[-1]]
 
                     nc, sc, sw, Rx = self._single_profile(x_in, y_out, R, layers, layerdict, ldx, threshold)
-                    neuron_counts[ldx].append(nc)
-                    synapse_counts[ldx].update(sc)
-                    synapse_weights[ldx].append(sw)
+                    batch_counts[ldx] = (nc, sc, sw)
 
                     R = Rx
 
@@ -250,13 +252,32 @@ class TorchProfiler():
                     traceback.print_exc()
                     break
 
-            return Profile(neuron_counts=neuron_counts,
-                           synapse_counts=synapse_counts,
-                           synapse_weights=synapse_weights, num_inputs=1)
+            # single device to host transfer for the whole batch
+            widths = [nc.shape[1] for nc, _, _ in batch_counts.values()]
+            host = torch.cat([neurons.unsqueeze(1).to(torch.long)] +
+                             [nc.to(torch.long) for nc, _, _ in batch_counts.values()], dim=1).cpu()
+            y_max = y_max.cpu()
+            host_counts = torch.split(host[:, 1:], widths, dim=1) if widths else []
+
+            profiles = list()
+            for i, neuron in enumerate(host[:, 0].tolist()):
+                neuron_counts = defaultdict(list)
+                synapse_counts = defaultdict(Counter)
+                synapse_weights = defaultdict(list)
+                neuron_counts[0].append(neuron)
+                synapse_counts[0].update([(neuron, neuron, 0)])
+                synapse_weights[0].append(y_max[i])
+                for (ldx, (nc, sc, sw)), counts in zip(batch_counts.items(), host_counts):
+                    neuron_counts[ldx].append([counts[i].tolist()])
+                    synapse_counts[ldx].update(sc)
+                    synapse_weights[ldx].append(sw)
+                profiles.append(Profile(neuron_counts=neuron_counts,
+                                        synapse_counts=synapse_counts,
+                                        synapse_weights=synapse_weights, num_inputs=1))
+            return profiles
 
     def _contrib_max1d(self, x_in, y_out, R, layer, threshold=0.001):
 
-        neuron_counts = list()
         synapse_counts = Counter()
         synapse_weights = list()
         maxpool = self.model.available_modules()[layer[0]]
@@ -270,20 +291,17 @@ class TorchProfiler():
         maxpool.return_indices = True
         _, indices = maxpool.forward(x_in)
         maxpool.return_indices = tmp_return_indices
-        Rx = torch.nn.functional.max_unpool1d(input=R, indices=indices.cpu(), kernel_size=kernel_size, stride=stride,
+        Rx = torch.nn.functional.max_unpool1d(input=R, indices=indices, kernel_size=kernel_size, stride=stride,
                                               padding=maxpool.padding, output_size=x_in.shape)
 
 
         Rx_sum = torch.sum(Rx, dim=2)
-        K = int(threshold * len(Rx_sum.view(-1)))
-        TOPK_value_index = torch.topk(Rx_sum.view(-1), K)
-        neuron_counts.append(TOPK_value_index[1].tolist())
+        neuron_counts = self._topk_per_sample(Rx_sum, threshold)
 
         return neuron_counts, synapse_counts, synapse_weights, Rx
 
     def _contrib_adaptive_avg_pool1d(self, x_in, y_out, R, layer, threshold=0.001):
 
-        neuron_counts = list()
         synapse_counts = Counter()
         synapse_weights = list()
         avgpool = self.model.available_modules()[layer[0]]
@@ -293,27 +311,24 @@ class TorchProfiler():
         input_size = x_in.shape[-1]
         stride = (input_size // output_size)
         kernel_size = input_size - (output_size - 1) * stride
-        Rx = torch.zeros_like(x_in).cpu()  ###, dtype=np.float
+        Rx = torch.zeros_like(x_in)  ###, dtype=np.float
 
         for i in range(R.size(2)):
             for j in range(R.size(3)):
-                Z = x_in[:, :, i * stride:i * stride + kernel_size, j * stride:j * stride + kernel_size].cpu()
+                Z = x_in[:, :, i * stride:i * stride + kernel_size, j * stride:j * stride + kernel_size]
                 Zs = Z.sum(axis=(2, 3), keepdims=True)
                 Zs += 1e-12 * ((Zs >= 0).float() * 2 - 1)
                 Rx[:, :, i * stride:i * stride + kernel_size, j * stride:j * stride + kernel_size] += (
                         (Z / Zs) * R[:, :, i:i + 1, j:j + 1])
 
         Rx_sum = torch.sum(Rx, dim=2)
-        K = int(threshold * len(Rx_sum.view(-1)))
-        TOPK_value_index = torch.topk(Rx_sum.view(-1), K)
-        neuron_counts.append(TOPK_value_index[1].tolist())
+        neuron_counts = self._topk_per_sample(Rx_sum, threshold)
 
         return neuron_counts, synapse_counts, synapse_weights, Rx
 
     def _contrib_conv1d(self, x_in, y_out, R, layers,
                         threshold=0.001):  ###(self, x_in, y_out, ydx, layer, threshold=0.1)
         threshold = 0.1
-        neuron_counts = list()
         synapse_counts = Counter()
         synapse_weights = list()
         conv, actf = layers 
@@ -328,24 +343,20 @@ class TorchProfiler():
         W = conv._parameters['weight']
         B = conv._parameters['bias']
        
-        Z = torch.nn.functional.conv1d(x_in, weight=W, bias=None, stride=stride, padding=padding).cpu()
-        S = R / (Z + 1e-16 * ((Z >= 0).float() * 2 - 1.))
-        C = torch.nn.functional.conv_transpose1d(input=S, weight=W.cpu(), bias=None, stride=stride, padding=padding)
-        Rx = C * x_in.cpu()
+        Z = torch.nn.functional.conv1d(x_in, weight=W, bias=None, stride=stride, padding=padding)
+        S = R / self._stabilize(Z, 1e-16)
+        Rx = torch.nn.functional.conv_transpose1d(input=S, weight=W, bias=None, stride=stride, padding=padding)
+        Rx *= x_in
 
         Rx_sum = torch.sum(Rx, dim=2)
-        K = int(threshold * len(Rx_sum.view(-1)))
-        TOPK_value_index = torch.topk(Rx_sum.view(-1), K)
-        neuron_counts.append(TOPK_value_index[1].tolist())
+        neuron_counts = self._topk_per_sample(Rx_sum, threshold)
 
         return neuron_counts, synapse_counts, synapse_weights, Rx
 
     def _contrib_linear(self, x_in, y_out, R, layers, threshold=0.0001):
         threshold = 0.1
-        neuron_counts = list()
         synapse_counts = Counter()
         synapse_weights = list()
-        Rx = torch.zeros_like(x_in).cpu()
 
         if len(layers) == 1:
             linear = layers[0]
@@ -357,147 +368,35 @@ class TorchProfiler():
             actf = self.model.available_modules()[actf]
         linear = self.model.available_modules()[linear]
 
+        # flatten every sample separately, the relevance of sample i only depends on row i
         xshape = x_in.shape
-        xdims = x_in[0].shape
-        if len(xdims) > 1:
-            holdx = torch.Tensor(x_in.cpu())
-            x_in = x_in[0].view(-1).unsqueeze(0)
+        x_in = x_in.reshape(xshape[0], -1)
 
         W = linear._parameters['weight']
         B = linear._parameters['bias']
 
-        Z = torch.nn.functional.linear(x_in, W, bias=None).cpu()
-        S = R / (Z + 1e-16 * ((Z >= 0).float() * 2 - 1.))
-        Rx = torch.nn.functional.linear(S, W.t().cpu(), bias=None)
-        Rx *= x_in.cpu()
+        Z = torch.nn.functional.linear(x_in, W, bias=None)
+        S = R / self._stabilize(Z, 1e-16)
+        Rx = torch.mm(S, W)
+        Rx *= x_in
         Rx = Rx.reshape(xshape)
 
-        K = int(threshold * len(Rx.view(-1)))
-        TOPK_value_index = torch.topk(Rx.view(-1), K)
-        neuron_counts.append(TOPK_value_index[1].tolist())
+        neuron_counts = self._topk_per_sample(Rx, threshold)
 
         return neuron_counts, synapse_counts, synapse_weights, Rx
 
 
 def iid(dataset, num_users, degree):
-    num_normal = 280000 // num_users
-    num_attack = 280000 // (num_users * degree)
-    dict_users = {i: np.array([], dtype='int64') for i in range(num_users)}
-    idxs = np.arange(280000 * 2)
-    labels = dataset.y_train
-    # sort labels
-    idxs_labels = np.vstack((idxs, labels))  ###[[idxs 0,1,2,3],[labels 5,5,7,2]]
-    idxs_labels = idxs_labels[:, idxs_labels[1, :].argsort()]
-    idxs = idxs_labels[0, :]  ### idxs前224000为正常类样本的index，后面每116000为下一类
-    dict_class_index = {}  # {i: [] for i in range(7)}
-    dict_class_index[0] = idxs[0:280000]
-    for i in range(1, 5):
-        dict_class_index[i] = idxs[280000 + (i - 1) * 70000:280000 + i * 70000]
-    comb = list()
-    for i in range(int(math.ceil(num_users / len(list(combinations([i for i in range(1, 5)], degree)))))):
-        comb += list(combinations([i for i in range(1, 5)], degree))
-    # comb_rand = random.sample(comb, 100)
-    comb_rand = comb[0:100]
-    print('comb', len(comb_rand))
-    for i, classes in enumerate(comb_rand):
-        # rand_set_normal = np.random.choice(dict_class_index[0], num_normal, replace=False)
-        rand_set_normal = dict_class_index[0][0:num_normal]
-        dict_users[i] = np.concatenate((dict_users[i], rand_set_normal), axis=0)
-        dict_class_index[0] = list(set(dict_class_index[0]) - set(rand_set_normal))
-        for cls in classes:
-            if len(dict_class_index[cls]) >= num_attack:
-                # rand_set_attack = np.random.choice(dict_class_index[cls], num_attack, replace=False)
-                rand_set_attack = dict_class_index[cls][0:num_attack]
-                dict_users[i] = np.concatenate((dict_users[i], rand_set_attack), axis=0)
-                dict_class_index[cls] = list(set(dict_class_index[cls]) - set(rand_set_attack))
-            else:
-                dict_users[i] = np.concatenate((dict_users[i], dict_class_index[cls]), axis=0)
+    ###### equal share of the normal class plus num_attack samples of each class of a combination of degree attack classes
+    dict_users = class_combination_partition(dataset.y_train, num_users, degree, weights=dataset.w_train)
+    print('comb', len(dict_users))
     return dict_users
 
 
-def test_img(net_g, datatest):
+def test_img(net_g, evaluator):
     net_g.eval()
-    # testing
-    test_loss = 0
-    correct = 0
-    data_pred = []
-    data_label = []
-    x = datatest.x_train
-    y = datatest.y_train
-    anomaly_list = [i for i in range(len(y)) if y[i] != 0]
-    y[anomaly_list] = 1
-    dataset_test = ReadData(x, y)
-    data_loader = DataLoader(dataset_test, batch_size=test_BatchSize)
-    loss = torch.nn.CrossEntropyLoss()
-    for idx, (data, target) in enumerate(data_loader):
-        data, target = Variable(data).to(device), Variable(target).type(torch.LongTensor).to(device)
-        # data, target = Variable(data), Variable(target).type(torch.LongTensor)
-        log_probs = net_g(data)
-        # sum up batch loss
-        test_loss += loss(log_probs, target).item()
-        # test_loss += F.cross_entropy(log_probs, target, reduction='sum').item()
-        # get the index of the max log-probability
-        y_pred = log_probs.data.detach().max(1, keepdim=True)[1]
-        correct += y_pred.eq(target.data.detach().view_as(y_pred)).long().cpu().sum()
-        data_pred.append(y_pred.cpu().detach().data.tolist())
-        data_label.append(target.cpu().detach().data.tolist())
-    list_data_label = list(flatten(data_label))
-    list_data_pred = list(flatten(data_pred))
-    print(classification_report(list_data_label, list_data_pred))
-    print(confusion_matrix(list_data_label, list_data_pred))
-    print('test_loss', test_loss)
-    test_loss /= len(data_loader.dataset)
-    accuracy = 100.00 * correct / len(data_loader.dataset)
-    print('\nTest set: Average loss: {:.4f} \nAccuracy: {}/{} ({:.2f}%)\n'.format(
-        test_loss, correct, len(data_loader.dataset), accuracy))
-    return accuracy, test_loss
-
-
-def test_w(w, datatest):
-    net_w = CNN_UNSW().double().to(device)
-    net_w.load_state_dict(w)
-    net_w.eval()
-    # testing
-    test_loss = 0
-    correct = 0
-    data_pred = []
-    data_label = []
-    x = datatest.x_train
-    y = datatest.y_train
-    anomaly_list = [i for i in range(len(y)) if y[i] != 0]
-    y[anomaly_list] = 1
-    dataset_test = ReadData(x, y)
-    data_loader = DataLoader(dataset_test, batch_size=test_BatchSize)
-    loss = torch.nn.CrossEntropyLoss()
-    for idx, (data, target) in enumerate(data_loader):
-        data, target = Variable(data).to(device, dtype=torch.double), Variable(target).type(torch.LongTensor).to(device)
-        # data, target = Variable(data), Variable(target).type(torch.LongTensor)
-        log_probs = net_w(data)
-        # sum up batch loss
-        test_loss += loss(log_probs, target).item()
-        # test_loss += F.cross_entropy(log_probs, target, reduction='sum').item()
-        # get the index of the max log-probability
-        y_pred = log_probs.data.detach().max(1, keepdim=True)[1]
-        correct += y_pred.eq(target.data.detach().view_as(y_pred)).long().cpu().sum()
-        data_pred.append(y_pred.cpu().detach().data.tolist())
-        data_label.append(target.cpu().detach().data.tolist())
-    list_data_label = list(flatten(data_label))
-    list_data_pred = list(flatten(data_pred))
-    print(classification_report(list_data_label, list_data_pred))
-    print(confusion_matrix(list_data_label, list_data_pred))
-    # print('test_loss', test_loss)
-    test_loss /= len(data_loader.dataset)
-    accuracy = 100.00 * correct / len(data_loader.dataset)
-    return accuracy, test_loss
-
-
-def FedAvg(w):
-    w_avg = copy.deepcopy(w[0])
-    for k in w_avg.keys():
-        for i in range(1, len(w)):
-            w_avg[k] += w[i][k]
-        w_avg[k] = torch.div(w_avg[k], len(w))
-    return w_avg
+    ###### binary evaluation on the cached test set, see evaluation.Evaluator
+    return evaluator.evaluate(net_g)
 
 
 def getGradVec(w):
@@ -510,365 +409,403 @@ def getGradVec(w):
     return gradVec
 
 
-def defence_det(w, d_out):
-    w_avg = copy.deepcopy(w[0])
-    for k in w_avg.keys():
-        for i in range(1, len(w)):
-            ### 0:clean model，1:poisoned model
-            if d_out[i] == 0:
-                w_avg[k] += w[i][k]
-        w_avg[k] = torch.div(w_avg[k], (len(d_out) - sum(d_out)))
-    return w_avg
-
-
-def defence_our(omega_locals, w_locals, w_local_pre):
-    X_norm = []
-    selected_index = {}
-    for i in omega_locals[0].keys():
-        aggregate_index = list()
-        for j in range(0, len(omega_locals)):
-            aggregate_index.append(omega_locals[j][i])
-        selected_index[i] = Counter(list(chain(*aggregate_index)))
+def defence_agg(name, omega_locals, w_locals, w_local_pre, **options):
+    """
+    Robust aggregation of the clients of the last round with the backend name of AGGREGATORS,
+    'our' is the SOS filter of the paper. Returns the aggregated state_dict and the client labels
+    (1: rejected or altered by the backend), evaluated against the poisoned clients Y_norm.
+    """
     print('interation', interation, 'client', client)
-    # print('selected_index', selected_index)
-
-    for i in range(0, len(w_locals)):
-        selected_weights = []
-        all_weights = []
-        for n in w_locals[0].keys():
-            # print(n)
-            c = w_locals[i][n].cpu()
-            c_pre = w_local_pre[n].cpu()
-            # all_weights.append((c.view(-1).detach().numpy() - c_pre.view(-1).detach().numpy()))
-            selected_index_dict = dict(selected_index[n])
-            indice = []
-            for a in range(0, len(selected_index_dict)):
-                # if (list(selected_index_dict.values())[a] < 45)&(list(selected_index_dict.values())[a] >40):
-                if (list(selected_index_dict.values())[a] > 90):
-                    # if ((list(selected_index_dict.values())[a] > 30) & (list(selected_index_dict.values())[a] < 40)): # | (list(selected_index_dict.values())[a] > 95)
-                    indice.append(list(selected_index_dict.keys())[a])
-            if len(indice) > 0:
-                indices = torch.tensor(indice)
-                # print('indices', indices)
-                d = torch.index_select(c.view(-1), 0, indices)
-                d_pre = torch.index_select(c_pre.view(-1), 0, indices)
-                selected_weights.append((d.view(-1).detach().numpy() - d_pre.view(-1).detach().numpy()))
-            else:
-                pass
-        print(selected_weights)
-        X_norm.append(list(chain(*selected_weights)))
-        # X_all.append(list(chain(*all_weights)))
-
-    X_norm = np.array(X_norm)
-    # X_all = np.array(X_all)
-    print('X', X_norm.shape)
-    #### OUR
-    scaler = MinMaxScaler()
-    # scaler = StandardScaler()
-    scaler.fit(X_norm)
-    X_norm = scaler.transform(X_norm)
-    # outliers_fraction = float(num_poison_client/num_clients)
-    # print('######outliers_fraction',outliers_fraction)
-    random_state = 42
-    clf = SOS(contamination=0.4, perplexity=90)
-
-    clf.fit(X_norm)
-    pre_out_label = clf.labels_
+    w_glob, pre_out_label, _ = aggregate(name, w_locals, w_local_pre, omega_locals=omega_locals, **options)
     print('prediction', pre_out_label)
     print(confusion_matrix(Y_norm.astype(int), pre_out_label))
     print(classification_report(Y_norm.astype(int), pre_out_label))
     # print("train AC", accuracy_score(Y_norm.astype(int), pre_out_label))
-    ### Federated aggregation with defence
-    w_glob = defence_det(w_locals, pre_out_label)
     return w_glob, pre_out_label
 
 
-def consolidate(Model, Weight, MEAN_pre, epsilon):
-    OMEGA_current = {n: p.data.clone().zero_() for n, p in Model.named_parameters()}
-    for n, p in Model.named_parameters():
-        p_current = p.detach().clone()
-        p_change = p_current - MEAN_pre[n]
-        # W[n].add_((p.grad**2) * torch.abs(p_change))
-        # OMEGA_add = W[n]/ (p_change ** 2 + epsilon)
-        # W[n].add_(-p.grad * p_change)
-        OMEGA_add = torch.max(Weight[n], Weight[n].clone().zero_()) / (p_change ** 2 + epsilon)
-        # OMEGA_add = Weight[n] / (p_change ** 2 + epsilon)
-        # OMEGA_current[n] = OMEGA_pre[n] + OMEGA_add
-        OMEGA_current[n] = OMEGA_add
-    return OMEGA_current
+def train_client(net, x=None, y=None, epochs_per_task=1, batch_size=1024, poisoned=False, seed=None,
+                 precision='float32', omega_policy='layer', omega_k=None, w=None, index=None, shard=None):
+    """
+    Local training of one client, run in the process of a ClientExecutor worker.
+
+    Returns the trained state_dict, the indices of the important parameters of every
+    layer (omega_index, int32 arrays selected with omega_policy, see importance.select_topk)
+    and the poison flag of the client. Inputs are cast to the dtype of the parameters of net,
+    precision='bfloat16' autocasts the forward pass. w weights the loss of every row by its
+    multiplicity, one pass over a weighted row replaces the passes over its copies.
+    With index, x holds the features of the whole dataset and the client trains on its rows
+    index, y and w then follow the order of index. A shard of a ShardRegistry gives all four,
+    attached by name in a worker process.
+    """
+    if shard is not None:
+        x, y, w, index = shard.x, shard.labels(), shard.weights(), shard.index
+    if seed is not None:
+        torch.manual_seed(seed)
+    net = copy.deepcopy(net).to(device)
+    net.train()
+    dtype = next(net.parameters()).dtype
+
+    # opt_net = torch.optim.SGD(net.parameters(), lr=0.05, momentum=0.5) #0.05
+    opt_net = torch.optim.Adam(net.parameters())
+    tracker = ImportanceTracker(net, opt_net)
+    crit = torch.nn.CrossEntropyLoss(reduction='none' if w is not None else 'mean')
+    ldr_train = BatchLoader(x, y, index=index, weights=w, batch_size=batch_size, shuffle=True, dtype=dtype,
+                            device=device, labels_per_row=False)
+    dataset_size = len(ldr_train.index) if w is None else float(np.sum(w))
+
+    for epoch in range(1, epochs_per_task + 1):
+        correct = 0
+        for batch_idx, (images, labels, *weight) in enumerate(ldr_train):
+            net.zero_grad()
+            with autocast(precision, device):
+                scores = net(images)
+                ce_loss = crit(scores, labels)
+            pred = scores.max(1)[1]
+            if w is not None:
+                weight = weight[0].to(device, dtype=ce_loss.dtype)
+                ce_loss = (ce_loss * weight).sum() / weight.sum()
+                correct += (pred.eq(labels.data.view_as(pred)) * weight).sum().cpu()
+            else:
+                correct += pred.eq(labels.data.view_as(pred)).cpu().sum()
+            loss = ce_loss
+            loss.backward()
+            ###### the tracker accumulates w[n] -= grad * (p_new - p_old) around the step
+            opt_net.step()
+        Accuracy = 100. * correct.type(torch.FloatTensor) / dataset_size
+        print('Train Epoch:{}\tLoss:{:.4f}\tCE_Loss:{:.4f}\tAccuracy: {:.4f}'.format(epoch, loss.item(),
+                                                                                     ce_loss.item(), Accuracy))
+    # print(classification_report(labels.cpu().data.view_as(pred.cpu()), pred.cpu()))
+    omega_index = tracker.select(epsilon=0.0001, policy=omega_policy, k=omega_k)
+    tracker.remove()
+    return net.state_dict(), omega_index, poisoned
 
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
-    parser.add_argument('--defence', type=str, default="our", choices=["our"], help="name of aggregation method")
+    parser.add_argument('--defence', type=str, default="our", choices=list(AGGREGATORS),
+                        help="name of aggregation method of the last round")
     parser.add_argument('--prate', type=float, default=0.5, help="poison instance ratio")
     parser.add_argument('--Tattack', type=int, default=1, help="attack round")
+    parser.add_argument('--attack_rounds', type=str, default="",
+                        help="comma separated rounds with attacks, the last round ('') by default")
+    parser.add_argument('--attack_clients', type=int, default=40, help="max number of attacking clients per round")
+    parser.add_argument('--flip_ratio', type=float, default=0.8, help="fraction of the attack rows relabelled")
+    parser.add_argument('--flip_source', type=str, default="",
+                        help="comma separated classes flipped by the attack (targeted flip), every attack class ('') by default")
+    parser.add_argument('--flip_target', type=int, default=0, help="class the flipped rows are relabelled to")
+    parser.add_argument('--model_attack', type=str, default="", choices=[""] + list(MODEL_ATTACKS),
+                        help="alteration of the updates of the attacking clients, none by default")
+    parser.add_argument('--attack_scale', type=float, default=1.0, help="factor of the model attack")
+    parser.add_argument('--profile_cache', type=int, default=50000,
+                        help="max number of cached per-row profiles in the detection phase, 0 disables the cache")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="number of processes training clients concurrently, 1 trains them in the main process")
+    parser.add_argument('--threads_per_worker', type=int, default=1, help="torch threads of every training process")
+    parser.add_argument('--engine', type=str, default="process", choices=["process", "vmap"],
+                        help="local training engine: one model per client (process) or stacked clients (vmap)")
+    parser.add_argument('--vmap_clients', type=int, default=16, help="clients stacked per step of the vmap engine")
+    parser.add_argument('--precision', type=str, default="float32", choices=["float32", "bfloat16", "float64"],
+                        help="dtype of training, aggregation, evaluation and profiling (bfloat16: float32 weights, "
+                             "the training and evaluation forward passes autocast, profiling in float32)")
+    parser.add_argument('--update_store', type=str, default=None,
+                        help="file memory-mapping the (clients, params) matrix of client updates, in RAM if not set")
+    parser.add_argument('--fedavg_weight', type=str, default="uniform", choices=["uniform", "samples"],
+                        help="client weights of FedAvg in the rounds without defence")
+    parser.add_argument('--eval_batch', type=int, default=8192, help="test rows per forward pass of the evaluation")
+    parser.add_argument('--parity_check', type=int, default=0,
+                        help="compare the global model with its float64 version on this many test rows every round")
+    parser.add_argument('--sos_neighbors', type=int, default=0,
+                        help="nearest neighbours kept in the SOS affinities of the defence, more than its "
+                             "perplexity (90), 0 for all clients")
+    parser.add_argument('--byzantine', type=int, default=40, help="assumed number of malicious clients of krum/multi_krum")
+    parser.add_argument('--trim_ratio', type=float, default=0.1,
+                        help="fraction of the largest and of the smallest values dropped by trimmed_mean")
+    parser.add_argument('--clip_norm', type=float, default=None,
+                        help="L2 bound of the client updates of norm_clip, the median norm if not set")
+    parser.add_argument('--compare', type=str, default="",
+                        help="comma separated backends evaluated with the defence in one test pass, options as "
+                             "name:key=value, e.g. fedavg,trimmed_mean:trim_ratio=0.2,krum:num_byzantine=20")
+    parser.add_argument('--omega_policy', type=str, default="layer", choices=["layer", "global"],
+                        help="top-k of the important parameters of every client: per layer or over the whole model")
+    parser.add_argument('--omega_k', type=int, default=None,
+                        help="important parameters of the global policy, the total of the layer policy if not set")
+    parser.add_argument('--partition', type=str, default="combination", choices=list(PARTITIONS),
+                        help="client data: normal share + attack-class combinations, Dirichlet label skew or quantity skew")
+    parser.add_argument('--degree', type=int, default=1, help="attack classes per client of the combination partition")
+    parser.add_argument('--alpha', type=float, default=0.5, help="Dirichlet concentration of the dirichlet/quantity partitions")
+    parser.add_argument('--partition_seed', type=int, default=None, help="seed of the dirichlet/quantity partitions")
+    parser.add_argument('--seed', type=int, default=None,
+                        help="base seed of the client training, every client of every round gets its own seed derived "
+                             "from it, drawn and printed when not given")
+    parser.add_argument('--data_cache', type=str, default="prepared",
+                        help="directory of the prepared train/test arrays, reused while X.npy, Y_attack.npy and the "
+                             "sampling are unchanged ('' to resample every run)")
+    parser.add_argument('--weighted', action='store_true',
+                        help="train and test on the distinct rows weighted by their number of over-sampled copies")
+    parser.add_argument('--shard_backend', type=str, default="auto", choices=["auto", "shm", "file"],
+                        help="storage of the training set shared with the workers: POSIX shared memory, a memory-mapped "
+                             "file, or auto (the prepared file when memory-mapped, shared memory otherwise)")
     args = parser.parse_args()
 
     prate = args.prate
+    ###### one seed per client task, the same inline and in the worker processes
+    if args.seed is None:
+        args.seed = int(np.random.SeedSequence().generate_state(1)[0])
+    print('seed', args.seed)
     Ta = args.Tattack
     frac = 1.0
     num_clients = 100
     batch_size = 128
     test_BatchSize = 32
-    x_train, y_train, x_test, y_test = readdataset()
-    dataset_train = ReadData(x_train, y_train)
-    dataset_test = ReadData(x_test, y_test)
+    x_train, y_train, x_test, y_test, w_train, w_test = readdataset(cache_dir=args.data_cache or None,
+                                                                    weighted=args.weighted)
+    dataset_train = ReadData(x_train, y_train, w_train)
+    evaluator = Evaluator(x_test, y_test, w_test, batch_size=args.eval_batch, loss_block=test_BatchSize,
+                          precision=args.precision, device=device)
 
     save_global_model = 'save_model.pkl'
     # # IID Data
-    dict_clients = iid(dataset_train, num_clients, 1)
-
-    net_global = CNN_UNSW().double().to(device)
-    # net_global = MLP_UNSW().double().to(device)
+    if args.partition == 'combination':
+        dict_clients = iid(dataset_train, num_clients, args.degree)
+    else:
+        dict_clients = PARTITIONS[args.partition](dataset_train.y_train, num_clients, alpha=args.alpha,
+                                                  seed=args.partition_seed, weights=dataset_train.w_train)
+
+    net_global = CNN_UNSW().to(device, param_dtype(args.precision))
+    # net_global = MLP_UNSW().to(device, param_dtype(args.precision))
     w_glob = net_global.state_dict()
-    crit = torch.nn.CrossEntropyLoss()
     net_global.train()
-
-    x_client = {}
-    y_client = {}
-    normal_list_client = {}
-    anomaly_list_client = {}
-    for interation in range(Ta):
-        w_locals, loss_locals = [], []
-        w_local_pre = w_glob
-        omega_locals = []
-        Y_norm = np.empty(shape=[0, 1])
-
-        num_poison_client = 0
-        for client in range(num_clients):
-            net = copy.deepcopy(net_global).to(device)
-            net_pre = copy.deepcopy(net_global.state_dict())
-            net.train()
-            mean_pre = {n: p.clone().detach() for n, p in net.named_parameters()}
-            w = {n: p.clone().detach().zero_() for n, p in net.named_parameters()}
-
-            # opt_net = torch.optim.SGD(net.parameters(), lr=0.05, momentum=0.5) #0.05
-            opt_net = torch.optim.Adam(net.parameters())
-            print('interation', interation, 'client', client)
-            idx_traindataset = DatasetSplit(dataset_train, dict_clients[client])
-            x = idx_traindataset.features.detach().cpu().numpy()
-            y = idx_traindataset.labels.detach().cpu().numpy()
-
-            anomaly_list = [i for i in range(len(y)) if y[i] != 0]
-            y[anomaly_list] = 1
-            num_attack1 = np.sum(y == 1)
-            num_poison = int(num_attack1 * 0.8)  # 0.8
-
-            if (num_poison > 0) & (num_poison_client < 40) & (interation == (Ta - 1)):  # & (interation > 0)
-                num_poison_client += 1
-                Y_norm = np.row_stack((Y_norm, [1]))  ### 异常为1
-                print('########### Poison client', num_poison_client)
-                poison_client_flag = True
-                res_list = [i for i in range(len(y)) if y[i] == 1]  ###
-                res_list1 = [i for i in range(len(y)) if y[i] != 1]  ### normal
-                ###### label flipping attack
-                x1 = x[res_list1, :, :] ### clean data
-                y1 = y[res_list1] ### labels of clean data
-                y[res_list[0:num_poison]] = 0
-                x2 = x[res_list, :, :] ### poison data
-                y2 = y[res_list[0:num_poison]]
-                x = np.concatenate((x1, x2[0:int(prate * len(x2)), :, :]), axis=0)
-                y = np.concatenate((y1, y2[0:int(prate * len(x2))]), axis=0)
-                ldr_train = DataLoader(ReadData(x, y), batch_size=1024, shuffle=True)
+    executor = ClientExecutor(num_workers=args.workers, threads_per_worker=args.threads_per_worker)
+    vmap_trainer = VmapClientTrainer(clients_per_step=args.vmap_clients, precision=args.precision, device=device)
+    ###### the training set is shared once, clients are index arrays into it with their own label changes
+    registry = ShardRegistry(x_train, y_train != 0, w_train, backend=args.shard_backend)
+    ###### the shared shards and the worker processes are released whatever stops the run
+    try:
+        scenario = PoisoningScenario(rounds=[Ta - 1] if args.attack_rounds == '' else
+                                     [int(r) for r in args.attack_rounds.split(',')],
+                                     max_clients=args.attack_clients,
+                                     source_classes=None if args.flip_source == '' else
+                                     [int(c) for c in args.flip_source.split(',')],
+                                     target_class=args.flip_target, binary=True, flip_ratio=args.flip_ratio,
+                                     keep_ratio=prate, model_attack=args.model_attack or None, scale=args.attack_scale)
+
+        normal_list_client = {}
+        anomaly_list_client = {}
+        for interation in range(Ta):
+            ###### only the defence round keeps every client update, the other rounds fold them into a running average
+            w_locals = ClientUpdateStore(w_glob, num_clients, filename=args.update_store) \
+                if interation == (Ta - 1) else None
+            fedavg = StreamingFedAvg()
+            loss_locals = []
+            w_local_pre = w_glob
+            omega_locals = []
+            Y_norm = np.empty(shape=[0, 1])
+
+            ###### attacking clients of the round, their shards and the ground truth of their poisoned rows
+            attack_plan = scenario.plan(interation, y_train, dict_clients)
+            Y_norm = attack_plan.poisoned.astype(float).reshape(-1, 1)  ### 异常为1
+            client_tasks = []
+            for client in range(num_clients):
+                print('interation', interation, 'client', client)
+                poison_client_flag = bool(attack_plan.poisoned[client])
+                shard = registry.add(client, attack_plan.index[client],
+                                     label_positions=attack_plan.label_positions[client],
+                                     label_values=attack_plan.label_values[client] != 0)
                 epochs_per_task = 1
-                normal_list_client[client] = res_list1
-                anomaly_list_client[client] = [i for i in range(len(x1),(len(x1)+int(prate*len(x2))))]
-
+                if poison_client_flag:
+                    print('########### Poison client', int(attack_plan.poisoned[:client + 1].sum()))
+                    ###### clean rows first, then the kept attack rows (poison data, relabelled or not)
+                    normal_list_client[client] = np.flatnonzero(~attack_plan.truth[client]).tolist()
+                    anomaly_list_client[client] = np.flatnonzero(attack_plan.truth[client]).tolist()
+                elif interation == (Ta - 1):
+                    y = shard.labels()
+                    normal_list_client[client] = np.flatnonzero(y == 0).tolist()
+                    anomaly_list_client[client] = np.flatnonzero(y != 0).tolist()
+
+                client_tasks.append(dict(net=net_global, shard=shard, epochs_per_task=epochs_per_task, batch_size=1024,
+                                         poisoned=poison_client_flag, precision=args.precision,
+                                         omega_policy=args.omega_policy, omega_k=args.omega_k,
+                                         seed=int(np.random.SeedSequence([args.seed, interation,
+                                                                          client]).generate_state(1)[0])))
+
+            ###### clients are independent until the aggregation, train them concurrently
+            if args.engine == 'vmap':
+                client_results = vmap_trainer.train(client_tasks)
             else:
-                Y_norm = np.row_stack((Y_norm, [0]))
-                poison_client_flag = False
-                ldr_train = DataLoader(ReadData(x, y), batch_size=1024, shuffle=True)
-                epochs_per_task = 1
-                if interation == (Ta - 1):
-                    normal_list_client[client] = [i for i in range(len(y)) if y[i] == 0]
-                    anomaly_list_client[client] = [i for i in range(len(y)) if y[i] != 0]
-
-            if interation == (Ta - 1):
-                x_client[client] = x
-                y_client[client] = y
-
-            dataset_size = len(ldr_train.dataset)
-
-            for epoch in range(1, epochs_per_task + 1):
-                correct = 0
-                for batch_idx, (images, labels) in enumerate(ldr_train):
-                    old_par = {n: p.clone().detach() for n, p in net.named_parameters()}
-                    images, labels = Variable(images).to(device), Variable(labels).type(torch.LongTensor).to(device)
-                    net.zero_grad()
-                    scores = net(images)
-                    ce_loss = crit(scores, labels)
-                    loss = ce_loss
-                    grad_params = torch.autograd.grad(loss, net.parameters(), create_graph=True)
-                    pred = scores.max(1)[1]
-                    correct += pred.eq(labels.data.view_as(pred)).cpu().sum()
-                    loss.backward()
-                    opt_net.step()
-                    j = 0
-                    for n, p in net.named_parameters():
-                        # print(n,grad_params[j])
-                        w[n] -= (grad_params[j].clone().detach()) * (p.detach() - old_par[n])  ###
-                        j += 1
-                Accuracy = 100. * correct.type(torch.FloatTensor) / dataset_size
-                print('Train Epoch:{}\tLoss:{:.4f}\tCE_Loss:{:.4f}\tAccuracy: {:.4f}'.format(epoch, loss.item(),
-                                                                                             ce_loss.item(), Accuracy))
-            # print(classification_report(labels.cpu().data.view_as(pred.cpu()), pred.cpu()))
-            omega = consolidate(Model=net, Weight=w, MEAN_pre=mean_pre, epsilon=0.0001)
-            omega_index = {}
-            for k in omega.keys():
-                if len(omega[k].view(-1)) > 1000:
-                    Topk = 100
-                else:
-                    Topk = int(0.1 * len(omega[k].view(-1)))
-                Topk_value_index = torch.topk(omega[k].view(-1), Topk)
-                omega_index[k] = Topk_value_index[1].tolist()
-            omega_locals.append(omega_index)
-
-            w_locals.append(copy.deepcopy(net.state_dict()))
-
-        # Aggregation of the last round
-        if interation == (Ta - 1):
-            w_glob, pre_out_label = defence_our(omega_locals, w_locals, w_local_pre)
-            test_acc, test_loss = test_w(w_glob, dataset_test)
-            print('OUR Test set: Average loss: {:.4f} \tAccuracy: {:.2f}'.format(test_loss, test_acc))
-            print('########### Filter ###########')
-            normal_client_indexs = []
-            poison_client_indexs = []
-            for i in range(len(pre_out_label)):
-                if pre_out_label[i] == 1:
-                    poison_client_indexs.append(int(i))
+                client_results = executor.imap(train_client, client_tasks)
+            for client, (task, (w_local, omega_index, poison_client_flag)) in enumerate(zip(client_tasks, client_results)):
+                if w_locals is not None:
+                    omega_locals.append(omega_index)
+                    w_locals.append(w_local)
                 else:
-                    normal_client_indexs.append(int(i))
-            model = CNN_UNSW().to(device)  #
-            model.load_state_dict(w_glob)
-            model = model.eval()
-            profiler = TorchProfiler(model)
-            layerdict = profiler.create_layers(0)  #### all layers
-            print(layerdict)
-            tp = profiler.create_profile(torch.rand(1, 1, 40), layerdict, threshold=0.5, show_progress=False, parallel=False)
-            # profiling results for each class
-            class_profiles = dict()
-            selected_index = dict()
-            # profiling results for the malicious class
-            class_profiles_mal = dict()
-            iou_normal = dict()
-            iou_threshold = dict()
-            neuron_count = {1: 12, 2: 28, 3: 3, 4: 1, 5: 1} ### topK,k={12,28,3,1,1}
-            # neuron_count = {1: 12, 2: 28, 3: 16, 4: 8, 5: 8}
-            #####predefine class_profiles,class_profiles_mal,selected_index(class path),iou_normal(threshold)
-            for cls in range(2):
-                class_profiles[cls] = dict()
-                selected_index[cls] = dict()
-                class_profiles_mal[cls] = dict()
-                iou_normal[cls] = list()
-                for layer in tp.neuron_counts:
-                    class_profiles[cls][layer] = list()
-                    selected_index[cls][layer] = Counter({})
-                    class_profiles_mal[cls][layer] = list()
-                    print(tp.neuron_counts[layer])
-                    # print('Layer ', layer, 'the number of important neurons:', len(list(chain(tp.neuron_counts[layer][0]))))
-                    print('Layer ', layer, 'the number of important neurons:', len(list(chain(tp.neuron_counts[layer]))))
-
-            ### obtain the class paths of clean data at the clean client sides
-            for index in normal_client_indexs:
-                images = x_client[index]
-                labels = y_client[index]
-
-                normal_client_sampling_indexs = [i for i in range(len(labels))]
-                normal_client_sampling_index = np.random.choice(normal_client_sampling_indexs,
-                                                                int(len(labels) * 0.03),
-                                                                replace=False)
-
-                for i in normal_client_sampling_index:
-                    tprofiles = profiler.create_profile(torch.Tensor(images[i]).resize_(1, 1, 40),
-                                                        layerdict,
-                                                        threshold=0.5,
-                                                        show_progress=False,
-                                                        parallel=False)
-                    for layer in tprofiles.neuron_counts:
-                        if layer == 0:
-                            ###### aggregate all samples' critical neuron
-                            # class_profiles[labels[i]][layer].append(tprofiles.neuron_counts[layer])
-                            ###### aggregate the correctly-predicted samples' critical neuron
-                            if (tprofiles.neuron_counts[0])[0] == labels[i]:
-                                class_profiles[labels[i]][layer].append(tprofiles.neuron_counts[layer])
-                        else:
-                            ###### aggregate all samples' critical neuron
-                            # class_profiles[labels[i]][layer].append(list(chain(*tprofiles.neuron_counts[layer][0])))
-                            ###### aggregate the correctly-predicted samples' critical neuron
-                            if (tprofiles.neuron_counts[0])[0] == labels[i]:
-                                class_profiles[labels[i]][layer].append(
-                                    list(chain(*tprofiles.neuron_counts[layer][0])))
-                        selected_index[labels[i]][layer] += Counter(list(chain(*class_profiles[labels[i]][layer])))
-            for cls in range(2):
-                for i in range(len(class_profiles[cls][1])):
-                    ious = list()
-                    for layer in range(1, 6):
-                        ious.append(jaccard_simple(set(class_profiles[cls][layer][i]),
-                                                   set([val[0] for j, val in enumerate(
-                                                       selected_index[cls][layer].most_common(
-                                                           neuron_count[layer]))])))
-                    avg_ious = np.mean(ious)
-                    iou_normal[cls].append(avg_ious)
-            for cls in range(2):
-                print('cls', cls, '| iou_normal', np.mean(np.array(iou_normal[cls])))
-                print(np.array(iou_normal[cls]))
-                # iou_threshold[cls] = np.median(np.array(iou_normal[cls]))                \
-                iou_threshold[cls] = np.percentile(np.array(iou_normal[cls]), 5)
-
-            print('iou_threshold', iou_threshold)
-            print('########### Normal client done')
-            ##### detect the poisoned data at the poisoned client
-            for client in poison_client_indexs:
-                images = x_client[client]
-                labels = y_client[client]
-                anomaly_list = anomaly_list_client[client]
-                normal_list = normal_list_client[client]
-
-                normal_list_predicted = []
-                anomaly_list_predicted = []
-                for i in range(len(labels)):
-                    tprofiles_mal = profiler.create_profile(torch.Tensor(images[i]).resize_(1, 1, 40),
-                                                            layerdict,
-                                                            threshold=0.5,
-                                                            show_progress=False,
-                                                            parallel=False)
-                    ious = list()
-                    for layer in range(1, 6):
-                        ious.append(jaccard_simple(set(list(chain(*tprofiles_mal.neuron_counts[layer][0]))),
-                                                   set([val[0] for j, val in enumerate(
-                                                       selected_index[labels[i]][layer].most_common(
-                                                           neuron_count[layer]))])))
-                    avg_ious = np.mean(ious)
-                    if avg_ious < iou_threshold[labels[i]]:
-                        anomaly_list_predicted.append(i)
-
-                # recall_normal = set(normal_list_predicted).intersection(set(normal_list))
-                recall_anomaly = set(anomaly_list_predicted).intersection(set(anomaly_list))
-                # print('normal 0', 'recall of predicted: ', len(recall_normal) / len(normal_list_predicted),
-                #       'recall of all: ', len(recall_normal) / len(normal_list))
-                print('anomaly 1', '| recall of predicted: ', len(recall_anomaly) / len(anomaly_list_predicted),
-                      '| recall of all: ', len(recall_anomaly) / len(anomaly_list), '| clean removed: ',
-                      (len(anomaly_list_predicted) - len(recall_anomaly)) / len(normal_list), '| recall_anomaly: ',
-                      len(recall_anomaly), len(anomaly_list), len(anomaly_list_predicted), len(normal_list))
-        else:
-            w_glob = FedAvg(w_locals)
-            # pass
-
-        # copy weight to net_glob
-        net_global.load_state_dict(w_glob)
-        net_global.eval()
-        acc_test, loss_test = test_img(net_global, dataset_test)
-        print("Testing accuracy: {:.2f}".format(acc_test))
-
-    model_dict = net_global.state_dict()
-    test_dict = {k: w_glob[k] for k in w_glob.keys() if k in model_dict}
-    model_dict.update(test_dict)
-    net_global.load_state_dict(model_dict)
-
+                    if poison_client_flag:
+                        w_local = scenario.attack_update(client, w_local, w_local_pre)
+                    num_samples = len(task['shard']) if registry.weights is None else \
+                        float(np.sum(task['shard'].weights()))
+                    fedavg.add(w_local, weight=num_samples if args.fedavg_weight == 'samples' else 1.)
+            if w_locals is not None:
+                scenario.attack_store(w_locals, np.flatnonzero(attack_plan.poisoned), w_local_pre)
+
+            # Aggregation of the last round
+            if interation == (Ta - 1):
+                agg_options = dict(n_neighbors=args.sos_neighbors or None, num_byzantine=args.byzantine,
+                                   trim_ratio=args.trim_ratio, clip_norm=args.clip_norm)
+                w_glob, pre_out_label = defence_agg(args.defence, omega_locals, w_locals, w_local_pre, **agg_options)
+                ###### the defence and the backends compared with it are evaluated in a single pass over the test set
+                candidates = OrderedDict([(args.defence, w_glob)])
+                for item in filter(None, args.compare.split(',')):
+                    name, *settings = item.split(':')
+                    options = dict(agg_options, **{k: ast.literal_eval(v) for k, v in (o.split('=') for o in settings)})
+                    candidates[item] = aggregate(name, w_locals, w_local_pre, omega_locals=omega_locals, **options)[0]
+                results = evaluator.evaluate_many(candidates, CNN_UNSW)
+                for name, (test_acc, test_loss) in results.items():
+                    print('{} Test set: Average loss: {:.4f} \tAccuracy: {:.2f}'.format(name.upper(), test_loss, test_acc))
+                test_acc, test_loss = results[args.defence]
+                print('########### Filter ###########')
+                normal_client_indexs = []
+                poison_client_indexs = []
+                for i in range(len(pre_out_label)):
+                    if pre_out_label[i] == 1:
+                        poison_client_indexs.append(int(i))
+                    else:
+                        normal_client_indexs.append(int(i))
+                model = CNN_UNSW().to(device, param_dtype(args.precision))  #
+                model.load_state_dict(w_glob)
+                model = model.eval()
+                profiler = TorchProfiler(model)
+                profile_cache = ProfileCache(maxsize=args.profile_cache)
+                layerdict = profiler.create_layers(0)  #### all layers
+                print(layerdict)
+                tp = profiler.create_profile(torch.rand(1, 1, 40), layerdict, threshold=0.5, show_progress=False, parallel=False)
+                # profiling results for each class
+                class_profiles = dict()
+                selected_index = ClassPathAccumulator()
+                # profiling results for the malicious class
+                class_profiles_mal = dict()
+                iou_normal = dict()
+                iou_threshold = dict()
+                neuron_count = {1: 12, 2: 28, 3: 3, 4: 1, 5: 1} ### topK,k={12,28,3,1,1}
+                # neuron_count = {1: 12, 2: 28, 3: 16, 4: 8, 5: 8}
+                #####predefine class_profiles,class_profiles_mal,selected_index(class path),iou_normal(threshold)
+                for cls in range(2):
+                    class_profiles[cls] = dict()
+                    class_profiles_mal[cls] = dict()
+                    iou_normal[cls] = list()
+                    for layer in tp.neuron_counts:
+                        class_profiles[cls][layer] = list()
+                        class_profiles_mal[cls][layer] = list()
+                        print(tp.neuron_counts[layer])
+                        # print('Layer ', layer, 'the number of important neurons:', len(list(chain(tp.neuron_counts[layer][0]))))
+                        print('Layer ', layer, 'the number of important neurons:', len(list(chain(tp.neuron_counts[layer]))))
+
+                ### obtain the class paths of clean data at the clean client sides
+                for index in normal_client_indexs:
+                    images = registry[index].rows()
+                    labels = registry[index].labels()
+
+                    normal_client_sampling_indexs = [i for i in range(len(labels))]
+                    normal_client_sampling_index = np.random.choice(normal_client_sampling_indexs,
+                                                                    int(len(labels) * 0.03),
+                                                                    replace=False)
+
+                    sampled_profiles = profiler.create_profiles(torch.Tensor(images[normal_client_sampling_index]),
+                                                                layerdict,
+                                                                threshold=0.5,
+                                                                show_progress=False,
+                                                                cache=profile_cache)
+                    client_labels = list()
+                    client_paths = defaultdict(list)
+                    for i, tprofiles in zip(normal_client_sampling_index, sampled_profiles):
+                        for layer in tprofiles.neuron_counts:
+                            if layer == 0:
+                                ###### aggregate all samples' critical neuron
+                                # class_profiles[labels[i]][layer].append(tprofiles.neuron_counts[layer])
+                                ###### aggregate the correctly-predicted samples' critical neuron
+                                if (tprofiles.neuron_counts[0])[0] == labels[i]:
+                                    class_profiles[labels[i]][layer].append(tprofiles.neuron_counts[layer])
+                            else:
+                                ###### aggregate all samples' critical neuron
+                                # class_profiles[labels[i]][layer].append(list(chain(*tprofiles.neuron_counts[layer][0])))
+                                ###### aggregate the correctly-predicted samples' critical neuron
+                                if (tprofiles.neuron_counts[0])[0] == labels[i]:
+                                    class_profiles[labels[i]][layer].append(
+                                        list(chain(*tprofiles.neuron_counts[layer][0])))
+                        if (tprofiles.neuron_counts[0])[0] == labels[i]:
+                            client_labels.append(labels[i])
+                            for layer in tprofiles.neuron_counts:
+                                client_paths[layer].append(class_profiles[labels[i]][layer][-1])
+                    ###### every correctly-predicted sample is counted once in the class path of its label
+                    if len(client_labels) > 0:
+                        selected_index.add_batch(client_labels, client_paths)
+                ###### the class paths are fixed from here on, encode them once
+                scorer = ClassPathScorer({cls: {layer: [val[0] for val in selected_index.most_common(
+                    cls, layer, neuron_count[layer])] for layer in range(1, 6)} for cls in range(2)})
+                for cls in range(2):
+                    sample_paths = {layer: class_profiles[cls][layer] for layer in range(1, 6)}
+                    cls_labels = np.full(len(class_profiles[cls][1]), cls)
+                    iou_normal[cls] = list(scorer.avg_ious(sample_paths, cls_labels))
+                for cls in range(2):
+                    print('cls', cls, '| iou_normal', np.mean(np.array(iou_normal[cls])))
+                    print(np.array(iou_normal[cls]))
+                    # iou_threshold[cls] = np.median(np.array(iou_normal[cls]))                \
+                    iou_threshold[cls] = np.percentile(np.array(iou_normal[cls]), 5)
+
+                print('iou_threshold', iou_threshold)
+                print(profile_cache)
+                print('########### Normal client done')
+                ##### detect the poisoned data at the poisoned client
+                for client in poison_client_indexs:
+                    images = registry[client].rows()
+                    labels = registry[client].labels()
+                    anomaly_list = anomaly_list_client[client]
+                    normal_list = normal_list_client[client]
+
+                    normal_list_predicted = []
+                    client_profiles = profiler.create_profiles(torch.Tensor(images),
+                                                               layerdict,
+                                                               threshold=0.5,
+                                                               show_progress=False,
+                                                               cache=profile_cache)
+                    sample_paths = {layer: [list(chain(*tprofiles_mal.neuron_counts[layer][0]))
+                                            for tprofiles_mal in client_profiles] for layer in range(1, 6)}
+                    avg_ious = scorer.avg_ious(sample_paths, labels)
+                    thresholds = np.array([iou_threshold[cls] for cls in scorer.classes])
+                    anomaly_list_predicted = np.flatnonzero(
+                        avg_ious < thresholds[scorer.class_positions(labels)]).tolist()
+
+                    # recall_normal = set(normal_list_predicted).intersection(set(normal_list))
+                    recall_anomaly = set(anomaly_list_predicted).intersection(set(anomaly_list))
+                    # print('normal 0', 'recall of predicted: ', len(recall_normal) / len(normal_list_predicted),
+                    #       'recall of all: ', len(recall_normal) / len(normal_list))
+                    print('anomaly 1', '| recall of predicted: ', len(recall_anomaly) / len(anomaly_list_predicted),
+                          '| recall of all: ', len(recall_anomaly) / len(anomaly_list), '| clean removed: ',
+                          (len(anomaly_list_predicted) - len(recall_anomaly)) / len(normal_list), '| recall_anomaly: ',
+                          len(recall_anomaly), len(anomaly_list), len(anomaly_list_predicted), len(normal_list))
+                print(profile_cache)
+            else:
+                w_glob = fedavg.result()
+                # pass
+
+            # copy weight to net_glob
+            net_global.load_state_dict(w_glob)
+            net_global.eval()
+            acc_test, loss_test = test_img(net_global, evaluator)
+            print("Testing accuracy: {:.2f}".format(acc_test))
+            if args.parity_check > 0:
+                print('float64 parity', args.precision, parity_check(net_global, x_test[:args.parity_check],
+                                                                     args.precision, device))
+
+        model_dict = net_global.state_dict()
+        test_dict = {k: w_glob[k] for k in w_glob.keys() if k in model_dict}
+        model_dict.update(test_dict)
+        net_global.load_state_dict(model_dict)
+    finally:
+        executor.close()
+        registry.close()
     net_global.eval()
-    acc_test, loss_test = test_img(net_global, dataset_test)
+    acc_test, loss_test = test_img(net_global, evaluator)
     print("Testing accuracy: {:.2f}".format(acc_test))
     ### save the model trained with the norm dataset
     torch.save(net_global,save_global_model)
@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+# @File    : partition.py
+
+import math
+from itertools import combinations
+import numpy as np
+
+
+def class_indices(labels):
+    """
+    Parameters
+    ----------
+    labels : array-like
+        (n,) integer class of every sample
+
+    Returns
+    -------
+     : dict
+        class -> np.ndarray of the indices of its samples, in increasing order
+    """
+    labels = np.asarray(labels).astype(np.int64)
+    order = np.argsort(labels, kind='stable')
+    counts = np.bincount(labels)
+    blocks = np.split(order, np.cumsum(counts)[:-1])
+    return {cls: blocks[cls] for cls in np.flatnonzero(counts)}
+
+
+def _gather_segments(order, starts, lengths):
+    # order[starts[i]:starts[i] + lengths[i]] for every segment i, concatenated without a python loop
+    lengths = np.asarray(lengths, dtype=np.int64)
+    total = int(lengths.sum())
+    segment_offsets = np.cumsum(lengths) - lengths
+    within = np.arange(total, dtype=np.int64) - np.repeat(segment_offsets, lengths)
+    return order[np.repeat(np.asarray(starts, dtype=np.int64), lengths) + within]
+
+
+def _row_cuts(weights, cuts):
+    # rows before each weight position of cuts, a row crossing a cut goes to the later side
+    return np.searchsorted(np.concatenate(([0], np.cumsum(weights))), cuts, side='left')
+
+
+def _sample_weights(labels, weights):
+    if weights is None:
+        return np.ones(len(labels), dtype=np.int64)
+    return np.asarray(weights).astype(np.int64)
+
+
+def _split_by_client(client_ids, samples, num_clients):
+    # dict client -> its samples, grouped with one stable sort
+    order = np.argsort(client_ids, kind='stable')
+    parts = np.split(samples[order], np.cumsum(np.bincount(client_ids, minlength=num_clients))[:-1])
+    return {i: parts[i].astype(np.int64) for i in range(num_clients)}
+
+
+def class_combination_partition(labels, num_clients, degree=1, normal_class=0, attack_classes=None,
+                                num_normal=None, num_attack=None, weights=None):
+    """
+    Partition of SecFedNIDS: every client gets an equal share of the normal samples and
+    num_attack samples of each of the attack classes of one combination of degree classes,
+    the combinations being assigned in turn.
+
+    Clients take consecutive disjoint blocks of every class. A client whose class has fewer
+    than num_attack samples left gets the remainder, shared by all such clients. With weights
+    the sizes count samples with their multiplicity and blocks end at the nearest row.
+
+    Parameters
+    ----------
+    labels : array-like
+        (n,) class of every sample
+    num_clients : int
+    degree : int
+        attack classes per client
+    normal_class : int
+    attack_classes : list of int, optional
+        every class other than normal_class present in labels by default
+    num_normal : int, optional
+        normal samples per client, (number of normal samples) // num_clients by default
+    num_attack : int, optional
+        samples per attack class and client, (number of normal samples) // (num_clients * degree) by default
+    weights : array-like, optional
+        (n,) integer multiplicity of every sample, see dataset_cache.resample_split_weighted
+
+    Returns
+    -------
+    dict_users : dict
+        client -> np.ndarray of sample indices
+    """
+    weights = _sample_weights(labels, weights)
+    by_class = class_indices(labels)
+    if attack_classes is None:
+        attack_classes = [cls for cls in sorted(by_class) if cls != normal_class]
+    normal = by_class.get(normal_class, np.zeros(0, dtype=np.int64))
+    normal_size = int(weights[normal].sum())
+    if num_normal is None:
+        num_normal = normal_size // num_clients
+    if num_attack is None:
+        num_attack = normal_size // (num_clients * degree)
+    comb = list(combinations(attack_classes, degree))
+    comb = np.array((comb * int(math.ceil(num_clients / len(comb))))[0:num_clients], dtype=np.int64)
+
+    # one segment per (client, class): normal samples first, then the classes of the combination,
+    # positioned in samples counted with their weights, then mapped to rows
+    pool = [normal] + [by_class.get(cls, np.zeros(0, dtype=np.int64)) for cls in attack_classes]
+    order = np.concatenate(pool)
+    pool_offsets = np.cumsum([0] + [int(weights[p].sum()) for p in pool])
+    client_ids = [np.arange(num_clients)]
+    starts = [pool_offsets[0] + np.minimum(np.arange(num_clients) * num_normal, normal_size)]
+    stops = [pool_offsets[0] + np.minimum(np.arange(1, num_clients + 1) * num_normal, normal_size)]
+    for j, cls in enumerate(attack_classes):
+        users, _ = np.nonzero(comb == cls)
+        rank = np.arange(len(users))
+        size = pool_offsets[j + 2] - pool_offsets[j + 1]
+        full = size // num_attack if num_attack > 0 else 0
+        start = np.minimum(rank, full) * num_attack
+        client_ids.append(users)
+        starts.append(pool_offsets[j + 1] + start)
+        stops.append(pool_offsets[j + 1] + np.where(rank < full, start + num_attack, size))
+    client_ids = np.concatenate(client_ids)
+    starts = _row_cuts(weights[order], np.concatenate(starts))
+    lengths = _row_cuts(weights[order], np.concatenate(stops)) - starts
+    samples = _gather_segments(order, starts, lengths)
+    return _split_by_client(np.repeat(client_ids, lengths), samples, num_clients)
+
+
+def dirichlet_partition(labels, num_clients, alpha=0.5, seed=None, weights=None):
+    """
+    Label skew: the samples of every class are shared among the clients with proportions
+    drawn from Dir(alpha), small alpha giving clients dominated by few classes.
+
+    Parameters
+    ----------
+    labels : array-like
+        (n,) class of every sample
+    num_clients : int
+    alpha : float
+        concentration of the Dirichlet distribution
+    seed : int, optional
+    weights : array-like, optional
+        (n,) integer multiplicity of every sample, the proportions apply to the weighted counts
+
+    Returns
+    -------
+    dict_users : dict
+        client -> np.ndarray of sample indices
+    """
+    rng = np.random.default_rng(seed)
+    weights = _sample_weights(labels, weights)
+    client_ids = list()
+    samples = list()
+    for cls, idxs in class_indices(labels).items():
+        proportions = rng.dirichlet(np.full(num_clients, alpha))
+        idxs = rng.permutation(idxs)
+        size = int(weights[idxs].sum())
+        cuts = (np.cumsum(proportions) * size).astype(np.int64)
+        cuts[-1] = size
+        counts = np.diff(np.concatenate(([0], _row_cuts(weights[idxs], cuts))))
+        client_ids.append(np.repeat(np.arange(num_clients), counts))
+        samples.append(idxs)
+    return _split_by_client(np.concatenate(client_ids), np.concatenate(samples), num_clients)
+
+
+def quantity_skew_partition(labels, num_clients, alpha=0.5, seed=None, weights=None):
+    """
+    Quantity skew: IID samples, client sizes proportional to a Dir(alpha) draw.
+
+    Parameters
+    ----------
+    labels : array-like
+        (n,) class of every sample, only its length is used
+    num_clients : int
+    alpha : float
+        concentration of the Dirichlet distribution
+    seed : int, optional
+    weights : array-like, optional
+        (n,) integer multiplicity of every sample, the sizes apply to the weighted counts
+
+    Returns
+    -------
+    dict_users : dict
+        client -> np.ndarray of sample indices
+    """
+    rng = np.random.default_rng(seed)
+    weights = _sample_weights(labels, weights)
+    proportions = rng.dirichlet(np.full(num_clients, alpha))
+    samples = rng.permutation(len(labels))
+    size = int(weights.sum())
+    cuts = (np.cumsum(proportions) * size).astype(np.int64)
+    cuts[-1] = size
+    counts = np.diff(np.concatenate(([0], _row_cuts(weights[samples], cuts))))
+    return _split_by_client(np.repeat(np.arange(num_clients), counts), samples, num_clients)
+
+
+PARTITIONS = {
+    'combination': class_combination_partition,
+    'dirichlet': dirichlet_partition,
+    'quantity': quantity_skew_partition,
+}
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+# @File    : precision.py
+
+import contextlib
+import copy
+import torch
+
+# parameter dtype of every precision setting, bfloat16 keeps float32 weights and autocasts the compute
+PRECISIONS = {'float64': torch.float64,
+              'float32': torch.float32,
+              'bfloat16': torch.float32}
+
+
+def param_dtype(precision):
+    """
+    Parameters
+    ----------
+    precision : str
+        one of PRECISIONS
+
+    Returns
+    -------
+     : torch.dtype
+        dtype of the model parameters and inputs
+    """
+    return PRECISIONS[precision]
+
+
+def autocast(precision, device):
+    """
+    Context manager running the enclosed forward passes in bfloat16 when precision is
+    'bfloat16', a no-op otherwise.
+    """
+    if precision == 'bfloat16':
+        return torch.autocast(device_type=torch.device(device).type, dtype=torch.bfloat16)
+    return contextlib.nullcontext()
+
+
+def parity_check(model, x, precision, device, batch_size=4096):
+    """
+    Compares the outputs of a model run at the given precision with the same weights in float64.
+
+    Parameters
+    ----------
+    model : torch.nn.Module
+    x : numpy.ndarray or torch.Tensor
+        inputs, e.g. a slice of the test set
+    precision : str
+    device : torch.device
+    batch_size : int, optional
+
+    Returns
+    -------
+    report : dict
+        max_abs_diff of the outputs and agreement, the fraction of identical predicted classes
+    """
+    reference = copy.deepcopy(model).to(device, torch.float64).eval()
+    tested = copy.deepcopy(model).to(device, param_dtype(precision)).eval()
+    x = torch.as_tensor(x)
+    max_abs_diff = 0.
+    agree = 0
+    with torch.inference_mode():
+        for start in range(0, len(x), batch_size):
+            batch = x[start:start + batch_size].to(device)
+            y_ref = reference(batch.to(torch.float64))
+            with autocast(precision, device):
+                y = tested(batch.to(param_dtype(precision)))
+            max_abs_diff = max(max_abs_diff, (y.to(torch.float64) - y_ref).abs().max().item())
+            agree += (y.argmax(1) == y_ref.argmax(1)).sum().item()
+    return {'max_abs_diff': max_abs_diff, 'agreement': agree / max(len(x), 1)}
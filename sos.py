@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+# @File    : sos.py
+
+import numpy as np
+import torch
+
+
+class StochasticOutlierSelection:
+    """
+    Stochastic Outlier Selection in torch, a drop-in for pyod.models.sos.SOS with the euclidean metric.
+
+    The affinity matrix is never held in full: rows are processed in chunks of chunk_size,
+    the perplexity binary search runs for all rows of a chunk at once, and the outlier
+    probability of every sample, prod_i (1 - b_ij), is accumulated chunk by chunk. With
+    n_neighbors each row only keeps its nearest neighbours, which bounds the memory by
+    n * n_neighbors and ignores the negligible affinities of distant samples.
+    """
+
+    def __init__(self, contamination=0.1, perplexity=4.5, eps=1e-5, n_neighbors=None, chunk_size=1024,
+                 max_tries=5000, dtype=torch.float64, device=torch.device('cpu')):
+        """
+        Parameters
+        ----------
+        contamination : float
+            fraction of outliers, labels_ marks the samples above the (1 - contamination) percentile
+        perplexity : float
+            effective number of neighbours of every sample
+        eps : float
+            tolerance of the entropy in the perplexity search
+        n_neighbors : int, optional
+            affinities restricted to the nearest neighbours, exact dense affinities if None. Must
+            exceed perplexity, fewer neighbours cannot reach its entropy
+        chunk_size : int
+            rows of the affinity matrix computed at once
+        max_tries : int
+            iterations of the perplexity search
+        dtype : torch.dtype
+            float64 reproduces pyod
+        device : torch.device
+        """
+        if n_neighbors is not None and n_neighbors <= perplexity:
+            raise ValueError(f'n_neighbors ({n_neighbors}) must be larger than perplexity ({perplexity}), '
+                             f'the perplexity search cannot converge on fewer neighbours')
+        self.contamination = contamination
+        self.perplexity = perplexity
+        self.eps = eps
+        self.n_neighbors = n_neighbors
+        self.chunk_size = chunk_size
+        self.max_tries = max_tries
+        self.dtype = dtype
+        self.device = device
+
+    def _distances(self, X, sum_x, rows):
+        # same expansion as pyod: sqrt(|x_i^2 - 2 x_i x_j + x_j^2|)
+        return torch.sqrt(torch.abs(sum_x[rows, None] - 2 * X[rows] @ X.T + sum_x[None, :]))
+
+    def _affinities(self, D, self_columns=None):
+        """
+        Perplexity search of every row of D at once, the per-row search of pyod in lockstep.
+
+        Parameters
+        ----------
+        D : torch.Tensor
+            (rows, columns) dissimilarities
+        self_columns : torch.Tensor, optional
+            (rows,) column of the sample itself in every row, excluded from its affinities
+
+        Returns
+        -------
+        A : torch.Tensor
+            (rows, columns) affinities, zero at self_columns
+        """
+        diagonal = None
+        if self_columns is not None:
+            diagonal = (torch.arange(D.shape[0], device=D.device), self_columns)
+            D = D.index_put(diagonal, torch.zeros((), dtype=D.dtype, device=D.device))
+        log_u = np.log(self.perplexity)
+        beta = torch.ones(D.shape[0], 1, dtype=D.dtype, device=D.device)
+        beta_min = torch.full_like(beta, -np.inf)
+        beta_max = torch.full_like(beta, np.inf)
+
+        def entropy(beta):
+            A = torch.exp(D * -beta)
+            if diagonal is not None:
+                A.index_put_(diagonal, torch.zeros((), dtype=A.dtype, device=A.device))
+            sum_a = A.sum(dim=1, keepdim=True)
+            return torch.log(sum_a) + beta * torch.linalg.vecdot(D, A).unsqueeze(1) / sum_a, A
+
+        H, A = entropy(beta)
+        for _ in range(self.max_tries):
+            h_diff = H - log_u
+            is_nan = torch.isnan(h_diff)
+            active = is_nan | (torch.abs(h_diff) > self.eps)
+            if not active.any():
+                break
+            higher = active & ~is_nan & (h_diff > 0)
+            lower = active & ~is_nan & (h_diff <= 0)
+            beta_min = torch.where(higher, beta, beta_min)
+            beta_max = torch.where(lower, beta, beta_max)
+            up = torch.where(torch.isinf(beta_max), beta * 2.0, (beta + beta_max) / 2.0)
+            down = torch.where(torch.isinf(beta_min), beta / 2.0, (beta + beta_min) / 2.0)
+            beta = torch.where(active & is_nan, beta / 10.0, torch.where(higher, up, torch.where(lower, down, beta)))
+            H, A = entropy(beta)
+        return A
+
+    def fit(self, X, y=None):
+        """
+        Parameters
+        ----------
+        X : array-like
+            (n_samples, n_features)
+        y : ignored
+
+        Returns
+        -------
+        self, with decision_scores_, threshold_ and labels_ as in pyod
+        """
+        X = torch.as_tensor(np.asarray(X), dtype=self.dtype, device=self.device)
+        n = X.shape[0]
+        sum_x = (X * X).sum(dim=1)
+        k = None if self.n_neighbors is None else min(self.n_neighbors, n - 1)
+        log_outlier = torch.zeros(n, dtype=self.dtype, device=self.device)
+        for start in range(0, n, self.chunk_size):
+            rows = torch.arange(start, min(start + self.chunk_size, n), device=self.device)
+            D = self._distances(X, sum_x, rows)
+            if k is None:
+                columns = None
+                A = self._affinities(D, self_columns=rows)
+            else:
+                # the sample itself is excluded from its neighbours
+                D[torch.arange(len(rows), device=self.device), rows] = np.inf
+                D, columns = torch.topk(D, k, dim=1, largest=False)
+                A = self._affinities(D)
+            B = A / A.sum(dim=1, keepdim=True)
+            if columns is None:
+                log_outlier += torch.log1p(-B).sum(dim=0)
+            else:
+                log_outlier.scatter_add_(0, columns.reshape(-1), torch.log1p(-B).reshape(-1))
+        self.decision_scores_ = torch.exp(log_outlier).cpu().numpy()
+        self.threshold_ = np.percentile(self.decision_scores_, 100 * (1 - self.contamination))
+        self.labels_ = (self.decision_scores_ > self.threshold_).astype('int').ravel()
+        return self
@@ -1,2 +1,6 @@
 from .torch_hook import TorchHook
-from .helpers import DDPCounter,get_index, submatrix_generator
\ No newline at end of file
+from .helpers import DDPCounter,get_index, submatrix_generator
+from .profile_cache import ProfileCache, model_fingerprint
+from .executor import ClientExecutor
+from .batch_loader import BatchLoader, shuffled_order
+from .shared_shards import SharedArray, Shard, ShardRegistry
@@ -0,0 +1,106 @@
+import warnings
+import numpy as np
+import torch
+
+
+def _as_tensor(array):
+    # zero-copy view of a numpy array (or memmap), tensors are used as they are
+    if isinstance(array, torch.Tensor):
+        return array
+    with warnings.catch_warnings():
+        # read-only arrays (np.load(mmap_mode='r')) are only ever read here
+        warnings.simplefilter('ignore', UserWarning)
+        return torch.from_numpy(np.asarray(array))
+
+
+def shuffled_order(n):
+    '''
+    Random permutation of range(n) with the draws of DataLoader(shuffle=True): the base seed
+    of its iterator, then the seed of the generator of RandomSampler, both from the global
+    torch random stream
+    '''
+    torch.empty((), dtype=torch.int64).random_()
+    seed = int(torch.empty((), dtype=torch.int64).random_().item())
+    generator = torch.Generator()
+    generator.manual_seed(seed)
+    return torch.randperm(n, generator=generator)
+
+
+class BatchLoader:
+    '''
+    Batches of the rows index of shared feature and label arrays
+
+    A client shard is just an index array into the arrays of the whole dataset. Every batch is
+    gathered with one index_select into buffers allocated once, so there are no per-sample
+    __getitem__ calls, no collation and no per-client copy of the features. The yielded tensors
+    are views of these buffers and are overwritten by the next batch.
+
+    With shuffle=True the order is drawn from the global torch random stream exactly like
+    DataLoader(shuffle=True), so the batches are those of the DataLoader it replaces.
+
+    Parameters
+    ----------
+    features : numpy.ndarray or torch.Tensor
+        (n, ...) features of the whole dataset
+    labels : numpy.ndarray or torch.Tensor
+        (n,) labels, or (len(index),) labels of the shard when labels_per_row is False
+    index : array-like, optional
+        rows of the shard, all the rows by default
+    weights : array-like, optional
+        multiplicity of the rows, indexed like labels; batches are then (x, y, w)
+    batch_size : int
+    shuffle : bool
+    dtype : torch.dtype, optional
+        dtype of the feature batches, the dtype of features by default
+    device : torch.device, optional
+    labels_per_row : bool
+        True if labels (and weights) hold one entry per row of features, False if one per index entry
+    '''
+
+    def __init__(self, features, labels, index=None, weights=None, batch_size=1024, shuffle=False, dtype=None,
+                 device=torch.device('cpu'), labels_per_row=True):
+        self.features = _as_tensor(features)
+        self.labels = _as_tensor(labels).long()
+        self.weights = None if weights is None else _as_tensor(weights)
+        self.index = torch.arange(len(self.features)) if index is None else torch.as_tensor(np.asarray(index),
+                                                                                          dtype=torch.long)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.device = device
+        self.labels_per_row = labels_per_row
+        dtype = self.features.dtype if dtype is None else dtype
+        size = min(batch_size, len(self.index))
+        self._x = torch.empty((size,) + tuple(self.features.shape[1:]), dtype=dtype)
+        # gather in the dtype of the source first when it differs, index_select cannot cast
+        self._staging = None if dtype == self.features.dtype else torch.empty_like(self._x, dtype=self.features.dtype)
+        self._y = torch.empty(size, dtype=torch.long)
+        self._w = None if self.weights is None else torch.empty(size, dtype=self.weights.dtype)
+        self._rows = torch.empty(size, dtype=torch.long)
+
+    def __len__(self):
+        return (len(self.index) + self.batch_size - 1) // self.batch_size
+
+    def _order(self):
+        if not self.shuffle:
+            return torch.arange(len(self.index))
+        return shuffled_order(len(self.index))
+
+    def __iter__(self):
+        order = self._order()
+        for start in range(0, len(order), self.batch_size):
+            positions = order[start:start + self.batch_size]
+            b = len(positions)
+            rows = torch.index_select(self.index, 0, positions, out=self._rows[:b])
+            if self._staging is None:
+                x = torch.index_select(self.features, 0, rows, out=self._x[:b])
+            else:
+                x = self._x[:b].copy_(torch.index_select(self.features, 0, rows, out=self._staging[:b]))
+            label_rows = rows if self.labels_per_row else positions
+            y = torch.index_select(self.labels, 0, label_rows, out=self._y[:b])
+            x = x.to(self.device, non_blocking=True)
+            y = y.to(self.device, non_blocking=True)
+            if self._w is None:
+                yield x, y
+            else:
+                w = torch.index_select(self.weights, 0, label_rows, out=self._w[:b])
+                yield x, y, w.to(self.device, non_blocking=True)
@@ -0,0 +1,79 @@
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+import multiprocessing
+import torch
+
+
+def _init_worker(num_threads):
+    torch.set_num_threads(num_threads)
+
+
+def _run_task(fn, kwargs):
+    return fn(**kwargs)
+
+
+class ClientExecutor:
+    '''
+    Runs independent client jobs in a pool of processes
+
+    Results are returned in the order of the submitted tasks, whatever the order the
+    workers finish in. With num_workers <= 1 the tasks run inline in the calling process.
+
+    Parameters
+    ----------
+    num_workers : int
+        number of worker processes
+    threads_per_worker : int
+        torch.set_num_threads of every worker, keeps num_workers * threads_per_worker within the cores
+    mp_context : str, optional
+        multiprocessing start method ('fork', 'spawn', 'forkserver'), platform default if None
+    '''
+
+    def __init__(self, num_workers=1, threads_per_worker=1, mp_context=None):
+        self.num_workers = num_workers
+        self.threads_per_worker = threads_per_worker
+        self.mp_context = mp_context
+        self._pool = None
+
+    def _get_pool(self):
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(max_workers=self.num_workers,
+                                             mp_context=multiprocessing.get_context(self.mp_context),
+                                             initializer=_init_worker,
+                                             initargs=(self.threads_per_worker,))
+        return self._pool
+
+    def map(self, fn, tasks):
+        '''
+        Parameters
+        ----------
+        fn : callable
+            module level function, it is pickled by reference to reach the workers
+        tasks : iterable of dict
+            keyword arguments of one call of fn per client
+
+        Returns
+        -------
+        list of the return values of fn, in the order of tasks
+        '''
+        return list(self.imap(fn, tasks))
+
+    def imap(self, fn, tasks):
+        '''
+        Lazy version of map: yields the return value of each task, in the order of tasks, as soon
+        as it is available, so the caller can consume a client while the others are still training.
+        '''
+        if self.num_workers <= 1:
+            return (fn(**task) for task in tasks)
+        return self._get_pool().map(_run_task, repeat(fn), tasks)
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,99 @@
+from collections import OrderedDict
+import hashlib
+import torch
+
+
+def model_fingerprint(model):
+    '''
+    Return a digest of the parameters and buffers of a model
+
+    Parameters
+    ----------
+    model : torch.nn.Module or dict
+        module or state_dict; two models with identical names, dtypes and values share a fingerprint
+    '''
+    state = model.state_dict() if isinstance(model, torch.nn.Module) else model
+    digest = hashlib.blake2b(digest_size=16)
+    for name, tensor in state.items():
+        digest.update(name.encode())
+        digest.update(str(tensor.dtype).encode())
+        digest.update(tensor.detach().cpu().contiguous().numpy().tobytes())
+    return digest.hexdigest()
+
+
+class ProfileCache:
+    """
+    Bounded least-recently-used store for profiles keyed by input content
+
+    Keys are built with make_key from the raw bytes of an input, the fingerprint of
+    the model that profiled it and the profiling settings, so byte-identical rows
+    (e.g. the duplicates produced by RandomOverSampler) are profiled only once.
+    Cached values are shared between every input that hits them and must be
+    treated as read-only.
+
+    Attributes
+    ----------
+    maxsize : int
+        maximal number of entries, the least recently used entry is evicted first
+    hits : int
+    misses : int
+    """
+
+    def __init__(self, maxsize=50000):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._store = OrderedDict()
+
+    @staticmethod
+    def make_key(fingerprint, row, *settings):
+        '''
+        Parameters
+        ----------
+        fingerprint : str
+            output of model_fingerprint
+        row : numpy.ndarray or torch.Tensor
+            a single input
+        settings : hashable
+            any parameter the cached value depends on (threshold, number of layers...)
+        '''
+        if isinstance(row, torch.Tensor):
+            row = row.detach().cpu().contiguous().numpy()
+        return (fingerprint, settings, row.dtype.str, row.tobytes())
+
+    def get(self, key):
+        '''
+        Return the value stored under key or None, counting a hit or a miss
+        '''
+        value = self._store.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self._store.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        if self.maxsize <= 0:
+            return
+        self._store[key] = value
+        self._store.move_to_end(key)
+        while len(self._store) > self.maxsize:
+            self._store.popitem(last=False)
+
+    def clear(self):
+        self._store.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._store)
+
+    def __contains__(self, key):
+        return key in self._store
+
+    def __repr__(self):
+        lookups = self.hits + self.misses
+        rate = self.hits / lookups if lookups > 0 else 0.
+        return (f'ProfileCache(size={len(self)}, maxsize={self.maxsize}, hits={self.hits}, '
+                f'misses={self.misses}, hit_rate={rate:.3f})')
@@ -0,0 +1,221 @@
+import os
+import tempfile
+from multiprocessing import shared_memory
+import numpy as np
+
+# arrays attached by this process, kept open for its lifetime: (kind, name, offset) -> (handle, array)
+_attached = dict()
+
+
+class SharedArray:
+    '''
+    An array other processes open by name instead of receiving a pickled copy
+
+    Only the name, shape and dtype are pickled. 'shm' copies the array once into POSIX shared
+    memory, 'file' memory-maps a .npy file: an array that already is a memory-mapped file
+    (np.load(mmap_mode=...)) is used as it is, anything else is written to directory once.
+    'auto' picks 'file' for memory-mapped arrays and 'shm' otherwise.
+
+    Parameters
+    ----------
+    kind : str
+        'shm' or 'file'
+    name : str
+        name of the shared memory block or path of the file
+    shape : tuple
+    dtype : str
+    offset : int
+        offset of the data in the file
+    '''
+
+    def __init__(self, kind, name, shape, dtype, offset=0):
+        self.kind = kind
+        self.name = name
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype).str
+        self.offset = offset
+        self._array = None
+        self._shm = None
+        self._written = None
+
+    @classmethod
+    def create(cls, array, backend='auto', directory=None, name='array'):
+        '''
+        Parameters
+        ----------
+        array : numpy.ndarray or np.memmap
+        backend : str
+            'auto', 'shm' or 'file'
+        directory : str, optional
+            directory of the 'file' backend, a temporary directory by default
+        name : str
+            file name of the 'file' backend
+
+        Returns
+        -------
+         : SharedArray
+            owner of the shared data, close() releases it
+        '''
+        is_file = isinstance(array, np.memmap) and array.filename is not None and array.flags.c_contiguous
+        if backend == 'auto':
+            backend = 'file' if is_file else 'shm'
+        if backend == 'file' and is_file:
+            shared = cls('file', os.path.abspath(array.filename), array.shape, array.dtype, array.offset)
+            shared._array = array
+        elif backend == 'file':
+            written = directory is None
+            directory = tempfile.mkdtemp(prefix='shards') if directory is None else directory
+            out = np.lib.format.open_memmap(os.path.join(directory, name + '.npy'), mode='w+', dtype=array.dtype,
+                                            shape=array.shape)
+            out[...] = array
+            out.flush()
+            shared = cls('file', os.path.abspath(out.filename), out.shape, out.dtype, out.offset)
+            shared._array = out
+            shared._written = out.filename if written else None
+        elif backend == 'shm':
+            shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+            shared = cls('shm', shm.name, array.shape, array.dtype)
+            shared._shm = shm
+            shared._array = np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)
+            shared._array[...] = array
+        else:
+            raise ValueError(f'unknown backend {backend}')
+        return shared
+
+    def __getstate__(self):
+        return dict(kind=self.kind, name=self.name, shape=self.shape, dtype=self.dtype, offset=self.offset)
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def __len__(self):
+        return self.shape[0]
+
+    @property
+    def array(self):
+        '''the data, attached by name on first use in a process that did not create it'''
+        if self._array is None:
+            key = (self.kind, self.name, self.offset)
+            if key not in _attached:
+                if self.kind == 'shm':
+                    shm = shared_memory.SharedMemory(name=self.name)
+                    _attached[key] = (shm, np.ndarray(self.shape, dtype=self.dtype, buffer=shm.buf))
+                else:
+                    _attached[key] = (None, np.memmap(self.name, dtype=self.dtype, mode='r', offset=self.offset,
+                                                      shape=self.shape))
+            self._array = _attached[key][1]
+        return self._array
+
+    def close(self):
+        '''releases the shared memory block or temporary file, only in the process that created it'''
+        self._array = None
+        if self._shm is not None:
+            self._shm.close()
+            self._shm.unlink()
+            self._shm = None
+        if self._written is not None:
+            os.remove(self._written)
+            os.rmdir(os.path.dirname(self._written))
+            self._written = None
+
+
+class Shard:
+    '''
+    The training data of one client: its rows of the shared arrays and the positions of the
+    rows whose label differs from the shared labels (label_positions into index, label_values)
+    '''
+
+    def __init__(self, features, labels, weights, index, label_positions=None, label_values=None):
+        self.features = features
+        self.shared_labels = labels
+        self.shared_weights = weights
+        self.index = np.asarray(index, dtype=np.int64)
+        self.label_positions = np.zeros(0, dtype=np.int64) if label_positions is None else \
+            np.asarray(label_positions, dtype=np.int64)
+        self.label_values = np.zeros(0, dtype=np.int64) if label_values is None else \
+            np.asarray(label_values, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.index)
+
+    @property
+    def x(self):
+        '''the shared features of the whole dataset, train_client indexes them with index'''
+        return self.features.array
+
+    def labels(self):
+        '''labels of the rows of the shard, overrides applied'''
+        y = np.asarray(self.shared_labels.array[self.index], dtype=np.int64)
+        y[self.label_positions] = self.label_values
+        return y
+
+    def weights(self):
+        return None if self.shared_weights is None else np.asarray(self.shared_weights.array[self.index])
+
+    def rows(self):
+        '''gathered copy of the features of the shard'''
+        return self.features.array[self.index]
+
+
+class ShardRegistry:
+    '''
+    Training arrays placed once in shared memory or a memory-mapped file, clients described
+    by index arrays into them
+
+    A Shard pickles to its index and label overrides plus the names of the shared arrays, so
+    worker processes attach to the data by name instead of receiving copies of it.
+
+    Parameters
+    ----------
+    features : numpy.ndarray
+        (n, ...) features of the whole training set
+    labels : numpy.ndarray
+        (n,) labels
+    weights : numpy.ndarray, optional
+        (n,) multiplicity of the rows
+    backend : str
+        see SharedArray.create
+    directory : str, optional
+        directory of the 'file' backend
+    '''
+
+    def __init__(self, features, labels, weights=None, backend='auto', directory=None):
+        self.features = SharedArray.create(features, backend, directory, 'features')
+        self.labels = SharedArray.create(np.ascontiguousarray(labels, dtype=np.int64), backend, directory, 'labels')
+        self.weights = None if weights is None else SharedArray.create(np.ascontiguousarray(weights), backend,
+                                                                         directory, 'weights')
+        self.shards = dict()
+
+    def add(self, client, index, label_positions=None, label_values=None):
+        '''
+        Parameters
+        ----------
+        client : hashable
+        index : array-like
+            rows of the client
+        label_positions, label_values : array-like, optional
+            the label of row index[label_positions[i]] is label_values[i] for this client
+
+        Returns
+        -------
+         : Shard
+        '''
+        self.shards[client] = Shard(self.features, self.labels, self.weights, index, label_positions, label_values)
+        return self.shards[client]
+
+    def __getitem__(self, client):
+        return self.shards[client]
+
+    def __contains__(self, client):
+        return client in self.shards
+
+    def close(self):
+        for shared in (self.features, self.labels, self.weights):
+            if shared is not None:
+                shared.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
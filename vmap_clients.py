@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+# @File    : vmap_clients.py
+
+import copy
+import numpy as np
+import torch
+from torch.func import functional_call, grad_and_value, vmap
+
+from importance import consolidate_flat, flat_slices, select_topk
+from precision import autocast
+from utils import shuffled_order
+
+
+class VmapClientTrainer:
+    """
+    Trains many copies of one model together with torch.func.
+
+    The parameters of all clients are stacked along a leading client dimension and a
+    single vmapped forward/backward pass runs one batch of every client per step. Each
+    client keeps its own shuffled data stream (the orders BatchLoader draws in train_client
+    from the same seed), its own Adam state (same update as
+    torch.optim.Adam with default hyper-parameters) and its own path-importance
+    accumulator w[n], so the results match the per-client loop of train_client.
+
+    Clients whose data is exhausted are masked out of the remaining steps: their loss
+    and gradients are zero and their Adam step is skipped.
+    """
+
+    def __init__(self, lr=1e-3, betas=(0.9, 0.999), eps=1e-8, clients_per_step=16, epsilon=0.0001,
+                 precision='float32', device=torch.device('cuda' if torch.cuda.is_available() else 'cpu')):
+        """
+        Parameters
+        ----------
+        lr, betas, eps : Adam hyper-parameters
+        clients_per_step : int
+            number of clients stacked together, bounds the memory of the stacked batches
+        epsilon : float
+            epsilon of consolidate_flat
+        precision : str
+            'bfloat16' autocasts the forward passes, the parameters and Adam state keep their dtype
+        device : torch.device
+        """
+        self.lr = lr
+        self.betas = betas
+        self.eps = eps
+        self.clients_per_step = clients_per_step
+        self.epsilon = epsilon
+        self.precision = precision
+        self.device = device
+
+    def train(self, tasks):
+        """
+        Parameters
+        ----------
+        tasks : list of dict
+            keyword arguments of train_client (net, x, y, epochs_per_task, batch_size, poisoned, seed,
+            omega_policy, omega_k, w, index, shard), every task must share the same model architecture and batch size
+
+        Returns
+        -------
+        list of (state_dict, omega_index, poisoned), in the order of tasks
+        """
+        # shards of a ShardRegistry: rows of the shared features with their own labels
+        tasks = [task if task.get('shard') is None else
+                 dict(task, x=task['shard'].x, y=task['shard'].labels(), w=task['shard'].weights(),
+                      index=task['shard'].index) for task in tasks]
+        results = list()
+        for start in range(0, len(tasks), self.clients_per_step):
+            results.extend(self._train_group(tasks[start:start + self.clients_per_step]))
+        return results
+
+    def _schedule(self, tasks, batch_size):
+        # one row of batch indices per step and client, -1 marks padding
+        schedules = list()
+        for task in tasks:
+            if task.get('seed') is not None:
+                torch.manual_seed(task['seed'])
+            n = len(task['y'])
+            batches = list()
+            for epoch in range(task.get('epochs_per_task', 1)):
+                perm = shuffled_order(n).numpy()
+                padded = np.full(int(np.ceil(n / batch_size)) * batch_size, -1, dtype=np.int64)
+                padded[:n] = perm
+                batches.append(padded.reshape(-1, batch_size))
+            schedules.append(np.concatenate(batches) if len(batches) > 0 else np.zeros((0, batch_size), np.int64))
+        steps = max(len(schedule) for schedule in schedules)
+        index = np.full((len(tasks), steps, batch_size), -1, dtype=np.int64)
+        for c, schedule in enumerate(schedules):
+            index[c, :len(schedule)] = schedule
+        return index
+
+    def _train_group(self, tasks):
+        batch_size = tasks[0].get('batch_size', 1024)
+        if any(task.get('batch_size', 1024) != batch_size for task in tasks):
+            raise ValueError('VmapClientTrainer needs the same batch size for every client')
+        model = copy.deepcopy(tasks[0]['net']).to(self.device)
+        model.train()
+        num_clients = len(tasks)
+        params = {n: torch.stack([dict(task['net'].named_parameters())[n].detach().to(self.device)
+                                  for task in tasks])
+                  for n, _ in model.named_parameters()}
+        buffers = {n: b.to(self.device) for n, b in model.named_buffers()}
+        mean_pre = {n: p.clone() for n, p in params.items()}
+        w = {n: torch.zeros_like(p) for n, p in params.items()}
+        exp_avg = {n: torch.zeros_like(p) for n, p in params.items()}
+        exp_avg_sq = {n: torch.zeros_like(p) for n, p in params.items()}
+        step = torch.zeros(num_clients, dtype=torch.float64, device=self.device)
+
+        # every client's rows in one array, padding entries point at an extra all-zero row
+        dtype = next(iter(params.values())).dtype
+        offsets = np.cumsum([0] + [len(task['y']) for task in tasks])
+        # tasks with an index train on those rows of a shared x, gathered once for the group
+        x_all = torch.as_tensor(np.concatenate([task['x'] if task.get('index') is None else task['x'][task['index']]
+                                                for task in tasks] + [np.zeros_like(tasks[0]['x'][:1])]),
+                                dtype=dtype, device=self.device)
+        y_all = torch.as_tensor(np.concatenate([task['y'] for task in tasks] + [np.zeros(1, dtype=np.int64)]),
+                                dtype=torch.long, device=self.device)
+        # multiplicity of every row, 0 for the padding row, so it doubles as the mask of the batches
+        weight_all = torch.as_tensor(np.concatenate([task['w'] if task.get('w') is not None else np.ones(len(task['y']))
+                                                     for task in tasks] + [np.zeros(1)]),
+                                     dtype=dtype, device=self.device)
+        index = self._schedule(tasks, batch_size)
+        valid = index >= 0
+        index = np.where(valid, index + offsets[:-1, None, None], offsets[-1])
+
+        def client_loss(p, x, y, mask):
+            with autocast(self.precision, self.device):
+                scores = functional_call(model, (p, buffers), (x,))
+                losses = torch.nn.functional.cross_entropy(scores, y, reduction='none')
+            loss = (losses * mask).sum() / mask.sum().clamp(min=1)
+            correct = ((scores.argmax(1) == y) * mask).sum()
+            return loss, (loss.detach(), correct)
+
+        batched_grad = vmap(grad_and_value(client_loss, has_aux=True))
+        beta1, beta2 = self.betas
+        correct = torch.zeros(num_clients, dtype=dtype, device=self.device)
+        last_loss = torch.zeros(num_clients, dtype=dtype, device=self.device)
+        for s in range(index.shape[1]):
+            rows = torch.as_tensor(index[:, s], device=self.device)
+            mask = weight_all[rows]
+            active = mask.sum(dim=1) > 0
+            grads, (_, (loss, batch_correct)) = batched_grad(params, x_all[rows], y_all[rows], mask)
+            correct += batch_correct
+            last_loss = torch.where(active, loss, last_loss)
+
+            step += active.to(step.dtype)
+            bias_correction1 = 1 - beta1 ** step.clamp(min=1)
+            bias_correction2 = 1 - beta2 ** step.clamp(min=1)
+            for n, p in params.items():
+                shape = (-1,) + (1,) * (p.dim() - 1)
+                on = active.view(shape)
+                g = grads[n]
+                exp_avg[n] = torch.where(on, exp_avg[n].lerp(g, 1 - beta1), exp_avg[n])
+                exp_avg_sq[n] = torch.where(on, exp_avg_sq[n] * beta2 + (1 - beta2) * g * g, exp_avg_sq[n])
+                denom = (exp_avg_sq[n].sqrt() / bias_correction2.sqrt().to(p.dtype).view(shape)).add_(self.eps)
+                update = exp_avg[n] / denom * (self.lr / bias_correction1).to(p.dtype).view(shape)
+                update = torch.where(on, update, torch.zeros_like(update))
+                # p_new - p_old = -update, same accumulator as train_client
+                w[n] -= g * (-update)
+                params[n] = p - update
+
+        slices = flat_slices(model.named_parameters())
+        flatten = lambda tensors, c: torch.cat([tensors[n][c].reshape(-1) for n in slices])
+        results = list()
+        for c, task in enumerate(tasks):
+            n = len(task['y']) if task.get('w') is None else float(np.sum(task['w']))
+            print('Train Epoch:{}\tLoss:{:.4f}\tCE_Loss:{:.4f}\tAccuracy: {:.4f}'.format(
+                task.get('epochs_per_task', 1), last_loss[c].item(), last_loss[c].item(),
+                100. * correct[c].item() / (n * task.get('epochs_per_task', 1))))
+            model.load_state_dict({**{k: v[c] for k, v in params.items()}, **buffers}, strict=True)
+            omega = consolidate_flat(flatten(params, c).detach(), flatten(w, c), flatten(mean_pre, c), self.epsilon)
+            omega_index = select_topk(omega, slices, policy=task.get('omega_policy', 'layer'), k=task.get('omega_k'))
+            state_dict = {k: v.detach().clone() for k, v in model.state_dict().items()}
+            results.append((state_dict, omega_index, task.get('poisoned', False)))
+        return results